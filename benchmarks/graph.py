@@ -0,0 +1,65 @@
+"""Seeded generator for synthetic monkey graphs.
+
+Degrees follow a power law: monkey i gets weight (i + 1) ** (-1 / (a - 1))
+and both ends of every edge are drawn in proportion to weight, so a few
+hubs have thousands of friends and most monkeys only a handful.
+"""
+import bisect
+import random
+
+from sqlalchemy import select, func
+
+from monkeyapp import versions
+from monkeyapp.database import db_session
+from monkeyapp.models import User, add_friendships, chunks, edges
+
+BATCH = 5000
+
+
+def cumulative_weights(n, exponent):
+    power = -1.0 / (exponent - 1.0)
+    total, weights = 0.0, []
+    for i in range(n):
+        total += (i + 1) ** power
+        weights.append(total)
+    return weights
+
+
+def generate(monkeys, mean_degree=10, exponent=2.5, best_friends=0.3,
+             seed=0):
+    """Fill an empty database with *monkeys* monkeys and their friends.
+
+    Roughly *best_friends* of the monkeys with friends get their lowest
+    friend id as best friend.
+    """
+    rng = random.Random(seed)
+    user = User.__table__
+    for start in range(0, monkeys, BATCH):
+        db_session.execute(user.insert().values([
+            dict(name=u"monkey%07i" % i, email=u"monkey%07i@example.com" % i,
+                 age=rng.randint(0, 40) if rng.random() > 0.1 else None,
+                 friend_count=0)
+            for i in range(start, min(start + BATCH, monkeys))]))
+    db_session.commit()
+    ids = [ident for ident, in db_session.query(User.id).order_by(User.id)]
+    weights = cumulative_weights(len(ids), exponent)
+
+    def pick():
+        return ids[bisect.bisect_left(weights, rng.random() * weights[-1])]
+
+    pairs = ((pick(), pick()) for _ in range(monkeys * mean_degree // 2))
+    for chunk in chunks(pairs, BATCH):
+        add_friendships(chunk)
+        db_session.commit()
+    if best_friends:
+        edge = edges()
+        first_friend = (
+            select([func.min(edge.c.m2_id)])
+            .where(edge.c.m1_id == User.id).as_scalar())
+        modulus = max(int(round(1 / best_friends)), 1)
+        (User.query.filter(User.id % modulus == 0, User.friend_count > 0)
+            .update({User.best_friend_id: first_friend},
+                    synchronize_session=False))
+    versions.bump()
+    db_session.commit()
+    return ids
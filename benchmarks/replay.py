@@ -0,0 +1,219 @@
+"""Replay recorded traffic and report throughput and latency.
+
+    python -m benchmarks.replay traffic.jsonl --speed 2
+    python -m benchmarks.replay traffic.jsonl --url http://127.0.0.1:8000 \\
+        --workers 16 --rps 200
+
+Requests come from a TRAFFIC_RECORD file (see monkeyapp.recorder) and
+are sent by --workers threads, to the app in this process or to a
+running server at --url, at their recorded spacing scaled by --speed or
+at a fixed --rps. Latency counts from when a request was due, so a
+server falling behind shows in it instead of slowing the schedule.
+"""
+import argparse
+import httplib
+import json
+import Queue
+import sys
+import threading
+import time
+import urlparse
+
+import monkeyapp
+from monkeyapp import database
+from benchmarks.run import percentile
+
+
+def load(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    records.sort(key=lambda record: record['ts'])
+    return records
+
+
+def schedule(records, speed=1.0, rps=None):
+    """Return (seconds after the start, record) pairs."""
+    if rps:
+        return [(float(i) / rps, record) for i, record in enumerate(records)]
+    first = records[0]['ts'] if records else 0
+    return [((record['ts'] - first) / speed, record) for record in records]
+
+
+def body(record):
+    return (record.get('body') or u'').encode('utf-8')
+
+
+class InProcess(object):
+    """Sends requests to *app* through a test client per thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def __call__(self, record):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(
+            record['path'], method=record['method'],
+            query_string=record.get('query') or None, data=body(record),
+            content_type=record.get('content_type'), buffered=True)
+        return response.status_code
+
+
+class Http(object):
+    """Sends requests to a server at *url*."""
+
+    def __init__(self, url, timeout=60):
+        parts = urlparse.urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+
+    def __call__(self, record):
+        connection = httplib.HTTPConnection(
+            self.host, self.port, timeout=self.timeout)
+        try:
+            path = record['path']
+            if record.get('query'):
+                path += '?' + record['query']
+            headers = {}
+            if record.get('content_type'):
+                headers['Content-Type'] = record['content_type']
+            connection.request(record['method'], path, body(record), headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+
+def replay(planned, send, workers):
+    """Send the *planned* requests with *workers* threads.
+
+    Returns (record, latency, status) triples, status None for requests
+    that failed to send, and the seconds the run took.
+    """
+    jobs = Queue.Queue()
+    results = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            due, record = job
+            try:
+                status = send(record)
+            except Exception:
+                status = None
+            latency = time.time() - due
+            with lock:
+                results.append((record, latency, status))
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    start = time.time()
+    for offset, record in planned:
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        jobs.put((start + offset, record))
+    for _ in threads:
+        jobs.put(None)
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start
+
+
+def endpoint_namer(app):
+    adapter = app.url_map.bind('localhost')
+
+    def name(record):
+        try:
+            endpoint, _ = adapter.match(record['path'], record['method'])
+        except Exception:
+            return 'unmatched'
+        return '%s %s' % (record['method'], endpoint)
+    return name
+
+
+def report(results, seconds, name):
+    """Summarize *results* overall and per endpoint named by *name*."""
+    def summary(rows):
+        latencies = [latency for _, latency, _ in rows]
+        errors = sum(1 for _, _, status in rows
+                     if status is None or status >= 500)
+        return dict(
+            requests=len(rows), errors=errors,
+            error_rate=float(errors) / len(rows),
+            p50=percentile(latencies, 0.5) * 1000,
+            p95=percentile(latencies, 0.95) * 1000,
+            p99=percentile(latencies, 0.99) * 1000)
+    groups = {}
+    for row in results:
+        groups.setdefault(name(row[0]), []).append(row)
+    total = summary(results) if results else dict(requests=0)
+    total.update(seconds=seconds,
+                 throughput=len(results) / seconds if seconds else 0.0)
+    return dict(total=total, endpoints=dict(
+        (endpoint, summary(rows)) for endpoint, rows in groups.items()))
+
+
+def print_report(result):
+    total = result['total']
+    print("%i requests in %.1f s, %.1f requests/s" % (
+        total['requests'], total['seconds'], total['throughput']))
+    print("%-45s %7s %9s %9s %9s %7s" % (
+        'endpoint', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    rows = sorted(result['endpoints'].items()) + [('total', total)]
+    for endpoint, r in rows:
+        if not r['requests']:
+            continue
+        print("%-45s %7i %9.2f %9.2f %9.2f %6.1f%%" % (
+            endpoint, r['requests'], r['p50'], r['p95'], r['p99'],
+            r['error_rate'] * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('traffic', help="NDJSON file of recorded requests")
+    parser.add_argument('--db', default='sqlite:////tmp/monkeybench.db',
+                        help="database of the in-process app")
+    parser.add_argument('--url', help="replay against this server instead")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="scale the recorded spacing by 1/SPEED")
+    parser.add_argument('--rps', type=float,
+                        help="send at a fixed rate instead")
+    parser.add_argument('--limit', type=int, help="replay the first LIMIT")
+    parser.add_argument('--json', help="also write the report here")
+    args = parser.parse_args(argv)
+
+    records = load(args.traffic)[:args.limit]
+    app = monkeyapp.create_app(args.db)
+    if args.url:
+        send = Http(args.url)
+    else:
+        with app.app_context():
+            database.create_all()
+        send = InProcess(app)
+    results, seconds = replay(
+        schedule(records, args.speed, args.rps), send, args.workers)
+    result = report(results, seconds, endpoint_namer(app))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    return 1 if result['total'].get('errors') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
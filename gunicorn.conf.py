@@ -0,0 +1,28 @@
+"""gunicorn settings, used as ``gunicorn -c gunicorn.conf.py start:app``."""
+import multiprocessing
+import os
+
+from monkeyapp import warmup
+from monkeyapp.cache import per_process
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '8000')
+# Workers only invalidate their own cache with a per-process backend, so
+# more than one needs a shared CACHE_BACKEND.
+if per_process(os.environ):
+    workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+    if workers > 1:
+        raise RuntimeError("WEB_CONCURRENCY=%i needs a shared CACHE_BACKEND"
+                           % workers)
+else:
+    workers = int(os.environ.get(
+        'WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# The master creates and warms up the app once, the workers fork from it.
+preload_app = True
+
+
+def pre_fork(server, worker):
+    warmup.before_fork(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    warmup.after_fork(server.app.wsgi())
@@ -0,0 +1,4 @@
+from monkeyapp.commands import main
+
+if __name__ == '__main__':
+    main()
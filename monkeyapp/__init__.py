@@ -1,11 +1,46 @@
+import os
+import time
+
 from flask import Flask
-from sqlalchemy import create_engine
 
 
-def create_app(db_uri):
+def create_app(db_uri, **config):
+    """Create the app on the database at *db_uri*.
+
+    *config* is applied before the engines and cache are set up, so it
+    can carry their settings.
+    """
+    started = time.time()
     app = Flask(__name__)
-    app.engine = create_engine(db_uri, convert_unicode=True)
     from monkeyapp.views import api
+    from monkeyapp.jsonapi import jsonapi
     app.register_blueprint(api)
+    app.register_blueprint(jsonapi)
     app.secret_key = "devays key"
+    app.config['MONKEYS_PER_PAGE'] = 50
+    app.config['FRIENDSHIP_STORAGE'] = os.environ.get(
+        'FRIENDSHIP_STORAGE', 'symmetric')
+    app.config.update(config)
+    from monkeyapp import warmup
+    # Must be in place before anything creates the Jinja environment.
+    app.jinja_options = dict(app.jinja_options, bytecode_cache=(
+        warmup.bytecode_cache(app.config.get('TEMPLATE_CACHE_DIR'))))
+    from monkeyapp.database import make_engine
+    app.engine = make_engine(db_uri, app.config)
+    from monkeyapp import routing
+    routing.init_app(app)
+    from monkeyapp.cache import FragmentCache, create_backend, per_process
+    if app.config.get('ASYNC_JOBS') and per_process(app.config):
+        # Job commits would only invalidate the job worker's cache.
+        raise ValueError("ASYNC_JOBS needs a shared CACHE_BACKEND")
+    app.cache = FragmentCache(create_backend(app.config))
+    from monkeyapp import profiles, metrics, assets, recorder
+    profiles.init_app(app)
+    metrics.init_app(app)
+    assets.init_app(app)
+    recorder.init_app(app)
+    app.warmup_seconds = {}
+    if app.config.get('WARMUP'):
+        warmup.warm_up(app)
+    app.startup_seconds = time.time() - started
     return app
@@ -0,0 +1,231 @@
+"""Friend graph statistics computed offline with NumPy.
+
+NumPy is only needed here, install it where the analytics command runs.
+"""
+import datetime
+import json
+import multiprocessing
+import time
+
+from sqlalchemy import Table, Column, Integer, Float, Text, DateTime
+from sqlalchemy import select, func, and_
+
+from monkeyapp.database import Base, db_session
+from monkeyapp.models import User, friendship
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# One row per run, the page shows the latest.
+graph_stats = Table(
+    'graph_stats', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('computed', DateTime, nullable=False),
+    Column('seconds', Float, nullable=False),
+    Column('monkeys', Integer, nullable=False),
+    Column('friendships', Integer, nullable=False),
+    Column('components', Integer, nullable=False),
+    Column('largest_component', Integer, nullable=False),
+    Column('triangles', Integer, nullable=False),
+    Column('average_clustering', Float, nullable=False),
+    Column('transitivity', Float, nullable=False),
+    # JSON lists of [value, count] pairs.
+    Column('degree_histogram', Text, nullable=False),
+    Column('component_sizes', Text, nullable=False),
+    Column('clustering_histogram', Text, nullable=False))
+
+FETCH = 100000
+CLUSTERING_BUCKETS = 10
+
+
+def load_graph():
+    """Stream the monkey ids and friendships into arrays.
+
+    Returns the sorted ids and two arrays of positions in them, one
+    entry per friendship.
+    """
+    # One statement, so the ids and friendships come from one snapshot:
+    # every monkey with each friend of a higher id, or with 0 (ids start
+    # at 1) when it has none. Either storage mode has every friendship
+    # once with m1_id < m2_id.
+    rows = db_session.execute(
+        select([User.id, func.coalesce(friendship.c.m2_id, 0)])
+        .select_from(User.__table__.outerjoin(friendship, and_(
+            friendship.c.m1_id == User.id,
+            friendship.c.m1_id < friendship.c.m2_id)))
+        .execution_options(stream_results=True))
+    parts = [numpy.zeros((0, 2), dtype=numpy.int64)]
+    while True:
+        batch = rows.fetchmany(FETCH)
+        if not batch:
+            break
+        parts.append(numpy.array([tuple(row) for row in batch],
+                                 dtype=numpy.int64))
+    rows = numpy.concatenate(parts)
+    ids = numpy.unique(rows[:, 0])
+    edges = rows[rows[:, 1] != 0]
+    return (ids, numpy.searchsorted(ids, edges[:, 0]),
+            numpy.searchsorted(ids, edges[:, 1]))
+
+
+def degrees(n, u, v):
+    return numpy.bincount(u, minlength=n) + numpy.bincount(v, minlength=n)
+
+
+def components(n, u, v):
+    """Label every node with the smallest node of its component.
+
+    Union-find by hooking every edge onto the smaller label and halving
+    paths, for all edges at once until nothing changes.
+    """
+    labels = numpy.arange(n)
+    while True:
+        lower = numpy.minimum(labels[u], labels[v])
+        before = labels.copy()
+        numpy.minimum.at(labels, labels[u], lower)
+        numpy.minimum.at(labels, labels[v], lower)
+        while True:
+            jumped = labels[labels]
+            if (jumped == labels).all():
+                break
+            labels = jumped
+        if (labels == before).all():
+            return labels
+
+
+# Set before the pool forks, so the workers share the arrays.
+_graph = {}
+
+
+def orient(n, u, v, degree):
+    """Build the sorted out-neighbours of every node, each edge pointing
+    from the end with fewer friends, so no node has more than about
+    sqrt(2 * edges) of them."""
+    forward = (degree[u] < degree[v]) | ((degree[u] == degree[v]) & (u < v))
+    tail = numpy.where(forward, u, v)
+    head = numpy.where(forward, v, u)
+    order = numpy.lexsort((head, tail))
+    tail, head = tail[order], head[order]
+    offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(tail, minlength=n), out=offsets[1:])
+    keys = numpy.sort(numpy.minimum(u, v) * n + numpy.maximum(u, v))
+    return offsets, head, keys
+
+
+def count_triangles(nodes):
+    """Return the triangles every node is in, over the triangles whose
+    lowest ranked node is in *nodes*."""
+    n, offsets, heads, keys = (
+        _graph['n'], _graph['offsets'], _graph['heads'], _graph['keys'])
+    counts = numpy.zeros(n, dtype=numpy.int64)
+    if not len(keys):
+        return counts
+    for node in nodes:
+        out = heads[offsets[node]:offsets[node + 1]]
+        if len(out) < 2:
+            continue
+        i, j = numpy.triu_indices(len(out), 1)
+        a, b = out[i], out[j]
+        wanted = numpy.minimum(a, b) * n + numpy.maximum(a, b)
+        found = keys[numpy.searchsorted(keys, wanted).clip(
+            max=len(keys) - 1)] == wanted
+        counts[node] += found.sum()
+        numpy.add.at(counts, a[found], 1)
+        numpy.add.at(counts, b[found], 1)
+    return counts
+
+
+def partition(offsets, parts):
+    """Split the nodes into *parts* runs of about equal work."""
+    out = numpy.diff(offsets)
+    work = numpy.cumsum(out * out)
+    if not len(work) or not work[-1]:
+        return [numpy.arange(len(out))]
+    bounds = numpy.searchsorted(
+        work, numpy.linspace(0, work[-1], parts + 1)[1:-1])
+    return numpy.split(numpy.arange(len(out)), bounds)
+
+
+def triangles(n, u, v, degree, processes=None):
+    """Return the number of triangles every node is in."""
+    offsets, heads, keys = orient(n, u, v, degree)
+    _graph.update(n=n, offsets=offsets, heads=heads, keys=keys)
+    processes = processes or multiprocessing.cpu_count()
+    try:
+        if processes == 1:
+            return count_triangles(numpy.arange(n))
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(count_triangles,
+                               partition(offsets, processes * 4))
+        finally:
+            pool.close()
+            pool.join()
+        return sum(results)
+    finally:
+        _graph.clear()
+
+
+def histogram(values):
+    counts = numpy.bincount(values)
+    return [[int(value), int(counts[value])]
+            for value in numpy.flatnonzero(counts)]
+
+
+def compute(processes=None):
+    """Compute the statistics of the friend graph as a dict of the
+    graph_stats columns."""
+    if numpy is None:
+        raise RuntimeError("graph statistics need numpy")
+    start = time.time()
+    ids, u, v = load_graph()
+    n = len(ids)
+    degree = degrees(n, u, v)
+    labels = components(n, u, v)
+    sizes = numpy.bincount(labels, minlength=n)
+    sizes = sizes[sizes > 0]
+    per_node = triangles(n, u, v, degree, processes)
+    pairs = degree * (degree - 1) // 2
+    wedges = int(pairs.sum())
+    clustering = numpy.zeros(n)
+    numpy.true_divide(per_node, pairs, out=clustering, where=pairs > 0)
+    buckets = numpy.minimum(
+        (clustering * CLUSTERING_BUCKETS).astype(numpy.int64),
+        CLUSTERING_BUCKETS - 1)
+    return dict(
+        computed=datetime.datetime.utcnow(),
+        seconds=time.time() - start,
+        monkeys=n,
+        friendships=len(u),
+        components=len(sizes),
+        largest_component=int(sizes.max()) if n else 0,
+        triangles=int(per_node.sum() // 3),
+        average_clustering=float(clustering.mean()) if n else 0.0,
+        transitivity=float(per_node.sum()) / wedges if wedges else 0.0,
+        degree_histogram=json.dumps(histogram(degree)),
+        component_sizes=json.dumps(histogram(sizes)),
+        # Bucket i holds clustering coefficients from i / 10 up.
+        clustering_histogram=json.dumps(histogram(buckets)))
+
+
+def refresh(processes=None):
+    """Compute the statistics and store them as the latest run."""
+    stats = compute(processes)
+    db_session.execute(graph_stats.insert().values(**stats))
+    db_session.commit()
+    return stats
+
+
+def latest():
+    row = db_session.execute(
+        graph_stats.select().order_by(graph_stats.c.id.desc()).limit(1)
+    ).first()
+    if row is None:
+        return None
+    stats = dict(row)
+    for key in ('degree_histogram', 'component_sizes',
+                'clustering_histogram'):
+        stats[key] = json.loads(stats[key])
+    return stats
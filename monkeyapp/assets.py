@@ -0,0 +1,227 @@
+"""Bundled, fingerprinted and precompressed static files.
+
+The bundles are built into static/dist when the app starts (or by
+``manage.py build-assets``) under names carrying a hash of their
+content, so they can be cached forever. Brotli copies are only written
+where the brotli module is installed.
+"""
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import tempfile
+import zlib
+
+from flask import abort, current_app, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bundle name and the static files it joins, minified ones used where
+# a .min variant sits next to them and scripts without one stripped.
+BUNDLES = (
+    ('app.css', ['bootstrap/css/bootstrap.css']),
+    ('app.js', ['jquery.js', 'bootstrap/js/bootstrap.js']),
+)
+OUTPUT = 'dist'
+MANIFEST = 'manifest.json'
+ONE_YEAR = 365 * 24 * 3600
+# Extensions that are already compressed.
+COMPRESSED = ('.woff', '.png', '.jpg', '.gif')
+CSS_URL = re.compile(r'''url\((['"]?)([^'")]+)\1\)''')
+
+
+def minified(static_folder, name):
+    base, ext = os.path.splitext(name)
+    if os.path.exists(os.path.join(static_folder, base + '.min' + ext)):
+        return base + '.min' + ext
+    return name
+
+
+def strip_js(data):
+    """Drop indentation, blank lines and whole-line comments from a script,
+    keeping /*! license comments.
+
+    Only what starts a line is looked at: outside a string, a line
+    starting with // or /* can only start a comment, and the scripts
+    bundled have no strings spanning lines.
+    """
+    lines = []
+    comment = keep = False
+    for line in data.splitlines():
+        line = line.strip()
+        if not comment and line.startswith('/*'):
+            comment, keep = True, line.startswith('/*!')
+            if not keep:
+                line = line[2:]
+        if comment:
+            end = line.find('*/')
+            if keep:
+                lines.append(line)
+            if end < 0:
+                continue
+            comment = False
+            if keep:
+                continue
+            line = line[end + 2:].strip()
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def fingerprint(name, data):
+    base, ext = os.path.splitext(os.path.basename(name))
+    return '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:12], ext)
+
+
+def write(folder, name, data):
+    # Written aside and renamed, so workers building at once never see
+    # half a file.
+    fd, temp = tempfile.mkstemp(dir=folder)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(temp, 0o644)
+    os.rename(temp, os.path.join(folder, name))
+
+
+def gzipped(data):
+    # A gzip header without name or time, so builds are reproducible.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Builder(object):
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self.folder = os.path.join(static_folder, OUTPUT)
+        self.files = {}
+        self.encodings = {}
+
+    def read(self, name):
+        with open(os.path.join(self.static_folder, name), 'rb') as f:
+            return f.read()
+
+    def emit(self, name, data):
+        """Write *data* under its fingerprinted name, with compressed
+        copies where they are worth it, and return that name."""
+        hashed = fingerprint(name, data)
+        write(self.folder, hashed, data)
+        encodings = []
+        if not name.endswith(COMPRESSED):
+            for encoding, compress in (('br', brotli and brotli.compress),
+                                       ('gzip', gzipped)):
+                if compress is None:
+                    continue
+                packed = compress(data)
+                if len(packed) < len(data) * 0.9:
+                    write(self.folder, '%s.%s' % (
+                        hashed, 'gz' if encoding == 'gzip' else encoding),
+                        packed)
+                    encodings.append(encoding)
+        self.files[name] = hashed
+        self.encodings[hashed] = encodings
+        return hashed
+
+    def rewrite_urls(self, name, css):
+        """Point the relative urls in the stylesheet *name* at
+        fingerprinted copies of what they reference."""
+        def replace(match):
+            quote, url = match.groups()
+            path, suffix = re.match(r'([^?#]*)(.*)', url).groups()
+            if ':' in path or path.startswith('/'):
+                return match.group(0)
+            target = os.path.normpath(
+                os.path.join(os.path.dirname(name), path))
+            if not os.path.isfile(os.path.join(self.static_folder, target)):
+                return match.group(0)
+            if target not in self.files:
+                self.emit(target, self.read(target))
+            return 'url(%s%s%s%s)' % (
+                quote, self.files[target], suffix, quote)
+        return CSS_URL.sub(replace, css)
+
+    def build(self):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        for bundle, sources in BUNDLES:
+            parts = []
+            for source in sources:
+                name = minified(self.static_folder, source)
+                data = self.read(name)
+                if bundle.endswith('.css'):
+                    data = self.rewrite_urls(name, data)
+                elif name == source:
+                    data = strip_js(data)
+                parts.append(data.strip())
+            separator = '\n' if bundle.endswith('.css') else ';\n'
+            self.emit(bundle, separator.join(parts) + '\n')
+        manifest = dict(files=self.files, encodings=self.encodings)
+        write(self.folder, MANIFEST, json.dumps(manifest, indent=1,
+                                                sort_keys=True))
+        return manifest
+
+
+def build(static_folder):
+    """Build the bundles into static/dist and return their manifest."""
+    return Builder(static_folder).build()
+
+
+# Manifests built by this process, so apps created again reuse them.
+built = {}
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, OUTPUT, MANIFEST)) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def asset_url(filename):
+    """Like url_for('static', filename=...), pointing at the
+    fingerprinted copy of bundles and the files they reference."""
+    hashed = current_app.assets['files'].get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('asset', filename=hashed)
+
+
+def serve_asset(filename):
+    encodings = current_app.assets['encodings'].get(filename)
+    if encodings is None:
+        abort(404)
+    path = os.path.join(current_app.static_folder, OUTPUT, filename)
+    encoding = None
+    for candidate in encodings:
+        if request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    if encoding is not None:
+        path += '.gz' if encoding == 'gzip' else '.' + encoding
+    # A real file lets the server send it with sendfile().
+    response = send_file(
+        path, mimetype=mimetypes.guess_type(filename)[0], conditional=True,
+        cache_timeout=ONE_YEAR)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = \
+        'public, max-age=%i, immutable' % ONE_YEAR
+    return response
+
+
+def init_app(app):
+    manifest = None
+    if not app.config.get('ASSETS_BUILD', True):
+        manifest = load_manifest(app.static_folder)
+    if manifest is None:
+        if app.static_folder not in built:
+            built[app.static_folder] = build(app.static_folder)
+        manifest = built[app.static_folder]
+    app.assets = manifest
+    app.add_url_rule('/assets/<path:filename>', 'asset', serve_asset)
+    app.add_template_global(asset_url)
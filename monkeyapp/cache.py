@@ -0,0 +1,154 @@
+import collections
+import os
+import threading
+import time
+import uuid
+
+from flask import current_app, has_request_context
+from jinja2 import Markup
+from werkzeug.contrib.cache import BaseCache, SimpleCache, NullCache
+from werkzeug.contrib.cache import MemcachedCache, RedisCache
+
+from monkeyapp import versions
+from monkeyapp.database import reading_replica
+
+
+class LRUCache(BaseCache):
+    """In-process cache keeping the most recently used entries.
+
+    Every worker has its own copy, so a write only invalidates the
+    worker that made it and the others catch up when entries time out.
+    Use a shared backend when running several workers.
+    """
+
+    def __init__(self, max_entries=1024, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            self._entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is not None:
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        return True
+
+
+def create_backend(config):
+    backend = config.get('CACHE_BACKEND', 'lru')
+    timeout = config.get('CACHE_TIMEOUT', 300)
+    if backend == 'lru':
+        return LRUCache(config.get('CACHE_SIZE', 1024), timeout)
+    if backend == 'memcached':
+        return MemcachedCache(
+            config.get('CACHE_SERVERS', ['127.0.0.1:11211']), timeout,
+            key_prefix='monkeys:')
+    if backend == 'redis':
+        return RedisCache(
+            config.get('CACHE_REDIS_HOST', 'localhost'),
+            config.get('CACHE_REDIS_PORT', 6379),
+            default_timeout=timeout, key_prefix='monkeys:')
+    if backend == 'simple':
+        # Local stand-in for a shared backend.
+        return SimpleCache(config.get('CACHE_SIZE', 1024), timeout)
+    if backend == 'null':
+        return NullCache()
+    raise ValueError("Unknown cache backend %r" % backend)
+
+
+def environ_config(environ=os.environ):
+    """Return the cache settings given in *environ*, for the web and job
+    workers to share one backend."""
+    return dict(
+        CACHE_BACKEND=environ.get('CACHE_BACKEND', 'lru'),
+        CACHE_SERVERS=environ.get('CACHE_SERVERS', '127.0.0.1:11211').split(),
+        CACHE_REDIS_HOST=environ.get('CACHE_REDIS_HOST', 'localhost'),
+        CACHE_REDIS_PORT=int(environ.get('CACHE_REDIS_PORT', 6379)))
+
+
+def per_process(config):
+    """Whether the configured backend keeps a cache per process, which
+    writes made by other processes leave stale."""
+    return config.get('CACHE_BACKEND', 'lru') == 'lru'
+
+
+class FragmentCache(object):
+    """Rendered page fragments with hit and miss counts per kind."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats = collections.defaultdict(
+            lambda: dict(hits=0, misses=0))
+
+    def fragment(self, kind, key, render):
+        value = self.backend.get(key)
+        if value is None:
+            self.stats[kind]['misses'] += 1
+            value = render()
+            timeout = None
+            if has_request_context() and reading_replica():
+                # The replica may not have the latest write yet.
+                timeout = current_app.config.get('REPLICA_CACHE_TIMEOUT', 10)
+            self.backend.set(key, value, timeout)
+        else:
+            self.stats[kind]['hits'] += 1
+        return Markup(value)
+
+    def list_key(self, *parts):
+        # Any write can move monkeys between list pages, so all of them
+        # share a generation that is replaced on every write. A fresh
+        # random generation is never mistaken for an evicted one.
+        generation = self.backend.get('list:generation')
+        if generation is None:
+            generation = self.new_generation()
+        return 'list:%s:%s' % (generation, ':'.join(
+            part or '' for part in parts))
+
+    def friends_key(self, ident, version):
+        # Keyed by version rather than deleted on writes, so a render that
+        # started before a write and is stored after it is never read.
+        return 'friends:%i:%i' % (ident, version)
+
+    def new_generation(self):
+        generation = uuid.uuid4().hex
+        self.backend.set('list:generation', generation)
+        return generation
+
+    def invalidate(self, ids):
+        self.new_generation()
+
+
+@versions.on_commit
+def invalidate(ids):
+    cache = getattr(current_app, 'cache', None)
+    if cache is not None:
+        cache.invalidate(ids)
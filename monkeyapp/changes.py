@@ -0,0 +1,276 @@
+"""A feed of every change to monkeys and friendships.
+
+Events are buffered while a transaction runs and written just before it
+commits, without a number. Readers number the committed events after
+every number handed out so far, taking turns on the change counter, so
+sequence numbers follow commit order and a consumer reading past seq N
+never misses a later commit with a lower number. Writers never wait on
+each other or on readers.
+
+Monkey events carry the monkey's full state and can be applied as
+upserts, which is what lets compaction keep only the latest event of
+each subject. Best friend links cleared by removing a friendship or
+deleting a monkey have their own events.
+"""
+import datetime
+import json
+import threading
+import time
+
+from sqlalchemy import Table, Column, Integer, String, Text, DateTime
+from sqlalchemy import DDL, Index, event, select, exists, and_, func
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import get_history
+
+from monkeyapp.database import Base, db_session, primary
+from monkeyapp.models import User, on_friendships_changed
+from monkeyapp.models import on_best_friends_cleared
+from monkeyapp.models import chunks, EDGE_CHUNK
+
+MONKEY_CREATED = 'monkey.created'
+MONKEY_UPDATED = 'monkey.updated'
+MONKEY_DELETED = 'monkey.deleted'
+FRIENDSHIP_ADDED = 'friendship.added'
+FRIENDSHIP_REMOVED = 'friendship.removed'
+BEST_FRIEND_CHANGED = 'best_friend.changed'
+
+BATCH = 500
+MAX_BATCH = 5000
+# Longest a request may wait for new changes, unless CHANGES_MAX_WAIT
+# says otherwise, and how often a waiting request looks for changes
+# committed by other workers. A waiting request holds its worker.
+MAX_WAIT = 2
+POLL_INTERVAL = 0.5
+RETENTION_DAYS = 7
+
+change_event = Table(
+    'change_event', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    # None until a reader numbers the event, after it committed.
+    Column('seq', Integer, unique=True),
+    Column('created', DateTime, nullable=False),
+    Column('kind', String(40), nullable=False),
+    # What the event is about, compaction keeps the latest per subject.
+    Column('subject', String(60), nullable=False),
+    Column('monkey_id', Integer, nullable=False),
+    Column('other_id', Integer),
+    Column('data', Text))
+Index('ix_change_event_subject_seq', change_event.c.subject,
+      change_event.c.seq)
+Index('ix_change_event_created', change_event.c.created)
+
+# A single row: the last sequence number handed out and the highest one
+# dropped by retention. Readers hold its lock while numbering events.
+change_counter = Table(
+    'change_counter', Base.metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('seq', Integer, nullable=False),
+    Column('purged', Integer, nullable=False))
+event.listen(change_counter, 'after_create', DDL(
+    'INSERT INTO change_counter (id, seq, purged) VALUES (1, 0, 0)'))
+
+
+class Expired(Exception):
+    """The changes after the requested sequence number are gone."""
+
+
+def monkey_state(monkey):
+    return dict(name=monkey.name, email=monkey.email, age=monkey.age)
+
+
+def record(session, kind, subject, monkey_id, other_id=None, data=None):
+    session.info.setdefault('changes', []).append(dict(
+        kind=kind, subject=subject, monkey_id=monkey_id, other_id=other_id,
+        data=json.dumps(data) if data is not None else None))
+
+
+def record_monkey(session, kind, monkey_id, data=None):
+    record(session, kind, 'monkey:%i' % monkey_id, monkey_id, data=data)
+
+
+def record_created(names):
+    """Record the monkeys named *names*, inserted without the ORM."""
+    for chunk in chunks(names, EDGE_CHUNK):
+        for monkey in User.query.filter(User.name.in_(chunk)):
+            record_monkey(db_session(), MONKEY_CREATED, monkey.id,
+                          monkey_state(monkey))
+
+
+@event.listens_for(User, 'after_insert')
+def monkey_inserted(mapper, connection, target):
+    record_monkey(object_session(target), MONKEY_CREATED, target.id,
+                  monkey_state(target))
+
+
+@event.listens_for(User, 'after_update')
+def monkey_updated(mapper, connection, target):
+    session = object_session(target)
+    if any(get_history(target, key).has_changes()
+           for key in ('name', 'email', 'age')):
+        record_monkey(session, MONKEY_UPDATED, target.id,
+                      monkey_state(target))
+    if get_history(target, 'best_friend').has_changes():
+        record(session, BEST_FRIEND_CHANGED, 'best_friend:%i' % target.id,
+               target.id, target.best_friend_id)
+
+
+@event.listens_for(User, 'after_delete')
+def monkey_deleted(mapper, connection, target):
+    record_monkey(object_session(target), MONKEY_DELETED, target.id)
+
+
+@on_best_friends_cleared
+def best_friends_cleared(ids):
+    for ident in ids:
+        record(db_session(), BEST_FRIEND_CHANGED, 'best_friend:%i' % ident,
+               ident)
+
+
+@on_friendships_changed
+def friendships_changed(pairs, sign):
+    kind = FRIENDSHIP_ADDED if sign > 0 else FRIENDSHIP_REMOVED
+    for pair in pairs:
+        a, b = sorted(pair)
+        record(db_session(), kind, 'friendship:%i:%i' % (a, b), a, b)
+
+
+@event.listens_for(Session, 'before_commit')
+def write_changes(session):
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    changes = session.info.pop('changes', None)
+    if not changes:
+        return
+    now = datetime.datetime.utcnow()
+    for change in changes:
+        change.update(seq=None, created=now)
+    session.execute(change_event.insert(), changes)
+    session.info['changes_written'] = True
+
+
+# Notified when this worker commits changes, to wake waiting requests.
+arrived = threading.Condition()
+
+
+@event.listens_for(Session, 'after_commit')
+def notify(session):
+    if session.info.pop('changes_written', False):
+        with arrived:
+            arrived.notify_all()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget(session):
+    session.info.pop('changes', None)
+    session.info.pop('changes_written', None)
+
+
+def first_unnumbered():
+    return db_session.execute(
+        select([func.min(change_event.c.id)])
+        .where(change_event.c.seq.is_(None))).scalar()
+
+
+def number_changes():
+    """Number the committed events without one, in the order they were
+    written.
+
+    Runs on the primary, since numbers read from a lagging replica would
+    repeat or go backwards.
+    """
+    counter = change_counter.c
+    with primary():
+        if first_unnumbered() is None:
+            return
+        # Locks the counter until the commit, so readers take turns.
+        db_session.execute(change_counter.update().where(counter.id == 1)
+                           .values(seq=counter.seq))
+        last = db_session.execute(
+            select([counter.seq]).where(counter.id == 1)).scalar()
+        first = first_unnumbered()
+        if first is not None:
+            # An event with a lower id committing meanwhile is left for
+            # the next reader, which numbers it after these.
+            db_session.execute(change_event.update().where(and_(
+                change_event.c.seq.is_(None), change_event.c.id >= first))
+                .values(seq=change_event.c.id + (last + 1 - first)))
+            db_session.execute(change_counter.update().where(
+                counter.id == 1).values(seq=select(
+                    [func.max(change_event.c.seq)]).as_scalar()))
+        db_session.commit()
+
+
+def read(since, limit):
+    number_changes()
+    purged = db_session.execute(
+        select([change_counter.c.purged])
+        .where(change_counter.c.id == 1)).scalar()
+    if since < purged:
+        raise Expired
+    return db_session.execute(
+        change_event.select().where(change_event.c.seq > since)
+        .order_by(change_event.c.seq).limit(limit)).fetchall()
+
+
+def poll(since, limit=BATCH, wait=0):
+    """Return up to *limit* changes after seq *since*, waiting up to
+    *wait* seconds for one to arrive.
+
+    Raises Expired if retention has dropped changes after *since*.
+    """
+    deadline = time.time() + wait
+    while True:
+        rows = read(since, limit)
+        remaining = deadline - time.time()
+        if rows or remaining <= 0:
+            return rows
+        # End the read so the next one sees newer commits.
+        db_session.rollback()
+        with arrived:
+            arrived.wait(min(POLL_INTERVAL, remaining))
+
+
+def change_dict(row):
+    return dict(
+        seq=row.seq, kind=row.kind, created=row.created.isoformat(),
+        monkey_id=row.monkey_id, other_id=row.other_id,
+        data=json.loads(row.data) if row.data is not None else None)
+
+
+def last_seq():
+    number_changes()
+    # Read where the caller reads, so a replica's number is never ahead
+    # of what it holds.
+    return db_session.execute(
+        select([change_counter.c.seq])
+        .where(change_counter.c.id == 1)).scalar()
+
+
+def compact(retention_days=RETENTION_DAYS):
+    """Drop the events superseded by a later one about the same subject
+    and those older than *retention_days*.
+
+    Returns the numbers of events compacted and expired.
+    """
+    number_changes()
+    newer = change_event.alias('newer')
+    superseded = exists().where(and_(
+        newer.c.subject == change_event.c.subject,
+        newer.c.seq > change_event.c.seq))
+    compacted = db_session.execute(
+        change_event.delete().where(superseded)).rowcount
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        days=retention_days)
+    horizon = db_session.execute(
+        select([func.max(change_event.c.seq)])
+        .where(change_event.c.created < cutoff)).scalar()
+    expired = 0
+    if horizon is not None:
+        expired = db_session.execute(change_event.delete().where(
+            change_event.c.seq <= horizon)).rowcount
+        db_session.execute(change_counter.update().where(
+            and_(change_counter.c.id == 1,
+                 change_counter.c.purged < horizon))
+            .values(purged=horizon))
+    db_session.commit()
+    return compacted, expired
@@ -1,16 +1,101 @@
-from sqlalchemy.orm import scoped_session, create_session
+import contextlib
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import scoped_session, Session
+from sqlalchemy.sql.expression import UpdateBase
 from sqlalchemy.ext.declarative import declarative_base
 
 from flask import current_app
 
-db_session = scoped_session(lambda: create_session(
+# create_engine arguments and the config keys they are read from.
+POOL_OPTIONS = (
+    ('pool_size', 'DATABASE_POOL_SIZE'),
+    ('max_overflow', 'DATABASE_MAX_OVERFLOW'),
+    ('pool_timeout', 'DATABASE_POOL_TIMEOUT'),
+    ('pool_recycle', 'DATABASE_POOL_RECYCLE'),
+)
+
+
+def ping(dbapi_connection, connection_record, connection_proxy):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        # The pool drops the connection and checks out a fresh one.
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def sqlite_connect(dbapi_connection, connection_record):
+    # pysqlite's own BEGIN and COMMIT handling breaks savepoints, so
+    # leave the transactions to sqlite_begin.
+    dbapi_connection.isolation_level = None
+
+
+def sqlite_begin(connection):
+    # On the DB-API connection, so it isn't counted as a query.
+    connection.connection.execute("BEGIN")
+
+
+def make_engine(uri, config):
+    """Create an engine for *uri* with the pool settings in *config*.
+
+    Settings left out use the dialect's default pool.
+    """
+    options = dict((option, config[key]) for option, key in POOL_OPTIONS
+                   if config.get(key) is not None)
+    engine = create_engine(uri, convert_unicode=True, **options)
+    if config.get('DATABASE_PRE_PING'):
+        event.listen(engine.pool, 'checkout', ping)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', sqlite_connect)
+        event.listen(engine, 'begin', sqlite_begin)
+    return engine
+
+
+class RoutingSession(Session):
+    """Reads from the engine in info['replica'] when one is set.
+
+    Flushes and insert, update and delete statements always go to the
+    primary, and mark the session as having written.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        else:
+            replica = self.info.get('replica')
+            if replica is not None:
+                return replica
+        return Session.get_bind(self, mapper, clause)
+
+
+db_session = scoped_session(lambda: RoutingSession(
     autocommit=False,
     autoflush=False,
+    expire_on_commit=False,
     bind=current_app.engine))
 Base = declarative_base()
 Base.query = db_session.query_property()
 
 
+def reading_replica():
+    return db_session().info.get('replica') is not None
+
+
+@contextlib.contextmanager
+def primary():
+    """Send the session's reads to the primary inside the block."""
+    info = db_session().info
+    replica = info.pop('replica', None)
+    try:
+        yield
+    finally:
+        if replica is not None:
+            info['replica'] = replica
+
+
 def create_all():
     init_db()
     pass
@@ -0,0 +1,92 @@
+import csv
+import json
+from cStringIO import StringIO
+
+from monkeyapp.database import db_session
+from monkeyapp.models import User, friendship, best_friend_alias
+
+# Rows fetched per round trip from the server side cursor.
+YIELD_PER = 1000
+# Rows serialized before a chunk is handed to the server.
+FLUSH_ROWS = 500
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+MONKEY_FIELDS = [
+    'id', 'name', 'email', 'age', 'best_friend_id', 'best_friend',
+    'friend_count']
+FRIENDSHIP_FIELDS = ['m1_id', 'm2_id']
+
+
+def stream(query):
+    # stream_results makes psycopg2 use a named, server side cursor.
+    return query.execution_options(stream_results=True).yield_per(YIELD_PER)
+
+
+def monkey_rows():
+    return stream(
+        db_session.query(
+            User.id, User.name, User.email, User.age,
+            best_friend_alias.id, best_friend_alias.name, User.friend_count)
+        .outerjoin(best_friend_alias,
+                   User.best_friend_id == best_friend_alias.id)
+        .order_by(User.id))
+
+
+def friendship_rows():
+    # Symmetric storage holds both directions and canonical storage only
+    # m1_id < m2_id, list every friendship once either way.
+    return stream(
+        db_session.query(friendship.c.m1_id, friendship.c.m2_id)
+        .filter(friendship.c.m1_id < friendship.c.m2_id)
+        .order_by(friendship.c.m1_id, friendship.c.m2_id))
+
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def write_csv(fields, rows):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    for i, row in enumerate(rows, 1):
+        writer.writerow([encode(value) for value in row])
+        if i % FLUSH_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def write_ndjson(fields, rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(fields, row))))
+        if len(lines) == FLUSH_ROWS:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+WRITERS = {
+    'csv': write_csv,
+    'ndjson': write_ndjson,
+}
+
+TABLES = {
+    'monkeys': (MONKEY_FIELDS, monkey_rows),
+    'friendships': (FRIENDSHIP_FIELDS, friendship_rows),
+}
+
+
+def export(table, format):
+    """Return a generator of CSV or NDJSON chunks for *table*."""
+    fields, rows = TABLES[table]
+    return WRITERS[format](fields, rows())
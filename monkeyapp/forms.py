@@ -1,4 +1,6 @@
-from wtforms import Form
+from wtforms import Form, IntegerField
+from wtforms.validators import Required
+from wtforms.widgets import HiddenInput
 from wtforms.ext.sqlalchemy.fields import QuerySelectField
 from wtforms_alchemy import model_form_factory
 
@@ -11,8 +13,7 @@ def query_users():
 
 
 class FriendForm(Form):
-    user = QuerySelectField(
-        get_label=u"name")
+    user = IntegerField(widget=HiddenInput(), validators=[Required()])
 
 
 class BestFriendForm(Form):
@@ -0,0 +1,175 @@
+import csv
+import json
+
+from wtforms.validators import Email
+
+from monkeyapp import versions, search, changes
+from monkeyapp.database import db_session
+from monkeyapp.models import User, add_friendships, chunks, EDGE_CHUNK
+
+# Records are validated and written this many at a time, so memory use
+# does not depend on the size of the file. Monkeys in a batch are
+# written before its friendships, and a friendship can only refer to
+# monkeys from its own or an earlier batch.
+BATCH_SIZE = 1000
+# Only the first errors are kept, the rest are only counted.
+MAX_ERRORS = 100
+
+email_regex = Email().regex
+
+
+class ImportResult(object):
+    def __init__(self):
+        self.monkeys = 0
+        self.friendships = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, message))
+
+    def as_dict(self):
+        return dict(
+            monkeys=self.monkeys, friendships=self.friendships,
+            error_count=self.error_count,
+            errors=[dict(line=line, message=message)
+                    for line, message in self.errors])
+
+
+def text(value):
+    if value is None:
+        return u''
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return unicode(value).strip()
+
+
+def read_csv(stream):
+    for line, row in enumerate(csv.DictReader(stream), 2):
+        yield line, row
+
+
+def read_ndjson(stream):
+    for line, data in enumerate(stream, 1):
+        if not data.strip():
+            continue
+        try:
+            record = json.loads(data)
+        except ValueError:
+            record = None
+        yield line, record if isinstance(record, dict) else None
+
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+}
+
+
+def parse_monkey(record):
+    name, email = text(record.get('name')), text(record.get('email'))
+    age = text(record.get('age')) or None
+    if not name or len(name) > 80:
+        raise ValueError("Invalid name")
+    if len(email) > 120 or not email_regex.match(email):
+        raise ValueError("Invalid email")
+    if age is not None:
+        try:
+            age = int(age)
+        except ValueError:
+            raise ValueError("Invalid age")
+        if age < 0:
+            raise ValueError("Invalid age")
+    return dict(name=name, email=email, age=age, friend_count=0)
+
+
+def import_monkeys(records, result):
+    rows, names, emails = [], {}, {}
+    for line, record in records:
+        try:
+            row = parse_monkey(record)
+        except ValueError as e:
+            result.error(line, e.args[0])
+            continue
+        if row['name'] in names or row['email'] in emails:
+            result.error(line, "Already exists")
+            continue
+        names[row['name']] = emails[row['email']] = line
+        rows.append((line, row))
+    taken = set()
+    for chunk in chunks(names, EDGE_CHUNK):
+        taken.update(name for name, in db_session.query(User.name)
+                     .filter(User.name.in_(chunk)))
+    for chunk in chunks(emails, EDGE_CHUNK):
+        taken.update(email for email, in db_session.query(User.email)
+                     .filter(User.email.in_(chunk)))
+    valid = []
+    for line, row in rows:
+        if row['name'] in taken or row['email'] in taken:
+            result.error(line, "Already exists")
+        else:
+            valid.append(row)
+    for chunk in chunks(valid, EDGE_CHUNK // 4):
+        db_session.execute(User.__table__.insert().values(chunk))
+    if valid:
+        versions.bump()
+        search.reload_index()
+        changes.record_created(row['name'] for row in valid)
+    result.monkeys += len(valid)
+
+
+def import_friendships(records, result):
+    edges = []
+    for line, record in records:
+        m1, m2 = text(record.get('m1')), text(record.get('m2'))
+        if not m1 or not m2 or m1 == m2:
+            result.error(line, "Invalid friendship")
+        else:
+            edges.append((line, m1, m2))
+    ids = {}
+    names = set(name for _, m1, m2 in edges for name in (m1, m2))
+    for chunk in chunks(names, EDGE_CHUNK):
+        ids.update((name, ident) for ident, name in
+                   db_session.query(User.id, User.name)
+                   .filter(User.name.in_(chunk)))
+    pairs = []
+    for line, m1, m2 in edges:
+        if m1 not in ids or m2 not in ids:
+            result.error(line, "Unknown monkey")
+        else:
+            pairs.append((ids[m1], ids[m2]))
+    result.friendships += len(add_friendships(pairs))
+
+
+def import_records(stream, format, batch_size=BATCH_SIZE):
+    """Import monkey and friendship records from a CSV or NDJSON stream.
+
+    Monkey records have name, email and age. Friendship records have
+    type "friendship" and the names of both monkeys in m1 and m2.
+    """
+    result = ImportResult()
+    for batch in chunks(READERS[format](stream), batch_size):
+        monkeys, friendships = [], []
+        for line, record in batch:
+            if record is None:
+                result.error(line, "Invalid record")
+                continue
+            kind = text(record.get('type'))
+            if kind in (u'', u'monkey'):
+                monkeys.append((line, record))
+            elif kind == u'friendship':
+                friendships.append((line, record))
+            else:
+                result.error(line, "Unknown type")
+        import_monkeys(monkeys, result)
+        import_friendships(friendships, result)
+        db_session.commit()
+    return result
+
+
+def guess_format(filename, default='csv'):
+    if filename and filename.rsplit('.', 1)[-1] in ('ndjson', 'jsonl'):
+        return 'ndjson'
+    return default
@@ -0,0 +1,243 @@
+"""Slow graph changes run as jobs, in worker processes or in the request.
+
+With ``ASYNC_JOBS`` set, views queue jobs as rows of the job table and
+answer at once with where to follow their status, and ``manage.py
+worker`` runs them; otherwise they run in the request that submits them
+and leave no row. Finished rows are dropped by ``manage.py prune-jobs``.
+Job commits only invalidate the caches of the worker process, so
+``ASYNC_JOBS`` needs a shared ``CACHE_BACKEND``, and the workers read the
+same cache settings from the environment as start.py.
+
+A job's changes commit together with its done state, and only while the
+worker still holds the job, so one interrupted halfway leaves nothing
+behind and is taken over once its lease runs out. Every job can run
+again without changing anything the second time.
+"""
+import datetime
+import json
+import multiprocessing
+import time
+import traceback
+
+from flask import current_app, jsonify, url_for
+from sqlalchemy import Table, Column, Integer, String, Text, DateTime
+from sqlalchemy import Index, and_
+
+from monkeyapp import models, recommendations
+from monkeyapp.cache import per_process
+from monkeyapp.database import Base, db_session
+from monkeyapp.models import User
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+MAX_ATTEMPTS = 5
+# Seconds a worker holds a job before another may take it over, and
+# the wait before a failed job is retried, times its attempts.
+LEASE = 600
+RETRY_DELAY = 30
+POLL_INTERVAL = 1
+RETENTION_DAYS = 7
+
+job = Table(
+    'job', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('kind', String(40), nullable=False),
+    Column('args', Text, nullable=False),
+    Column('state', String(10), nullable=False),
+    Column('attempts', Integer, nullable=False),
+    # Queued jobs wait until then, running ones are taken over after it.
+    Column('run_after', DateTime, nullable=False),
+    Column('created', DateTime, nullable=False),
+    Column('finished', DateTime),
+    Column('result', Text),
+    Column('error', Text))
+Index('ix_job_state_run_after', job.c.state, job.c.run_after)
+
+# Job kind -> function running it, called with the job's arguments.
+HANDLERS = {}
+
+
+def handler(f):
+    HANDLERS[f.__name__] = f
+    return f
+
+
+@handler
+def delete_monkey(ident):
+    monkey = User.query.get(ident)
+    if monkey is None:
+        return False
+    monkey.delete()
+    return True
+
+
+@handler
+def unfriend(ident, ids):
+    monkey = User.query.get(ident)
+    if monkey is None:
+        return []
+    return monkey.remove_friends(ids)
+
+
+@handler
+def recount_friends():
+    return models.recount_friends()
+
+
+@handler
+def build_recommendations():
+    # Commits as it goes, the monkeys built so far are not built again.
+    return recommendations.build_pending()
+
+
+def now():
+    return datetime.datetime.utcnow()
+
+
+def add(kind, args):
+    """Queue a *kind* job and return its id."""
+    if kind not in HANDLERS:
+        raise ValueError("Unknown job %r" % kind)
+    created = now()
+    return db_session.execute(job.insert().values(
+        kind=kind, args=json.dumps(args), state=QUEUED, attempts=0,
+        run_after=created, created=created)).inserted_primary_key[0]
+
+
+def submit(kind, **args):
+    """Queue a *kind* job and return (its row, None), or without
+    ASYNC_JOBS run it at once in the current transaction and return
+    (None, its result)."""
+    if current_app.config.get('ASYNC_JOBS', False):
+        return get(add(kind, args)), None
+    if kind not in HANDLERS:
+        raise ValueError("Unknown job %r" % kind)
+    return None, HANDLERS[kind](**args)
+
+
+def get(ident):
+    return db_session.execute(job.select().where(job.c.id == ident)).first()
+
+
+def claim():
+    """Take the next job that is due and return its row, None if there
+    is none."""
+    while True:
+        due = now()
+        row = db_session.execute(
+            job.select().where(and_(job.c.state.in_([QUEUED, RUNNING]),
+                                    job.c.run_after <= due))
+            .order_by(job.c.run_after, job.c.id).limit(1)).first()
+        if row is None:
+            db_session.commit()
+            return None
+        values = dict(state=RUNNING, attempts=row.attempts + 1,
+                      run_after=due + datetime.timedelta(seconds=LEASE))
+        if row.attempts >= MAX_ATTEMPTS:
+            # Its last worker died with it.
+            values = dict(state=FAILED, finished=due)
+        # Attempts only grow, so this fails if another worker took the
+        # job since it was read.
+        taken = db_session.execute(job.update().where(and_(
+            job.c.id == row.id, job.c.attempts == row.attempts))
+            .values(**values)).rowcount
+        db_session.commit()
+        if taken and values['state'] == RUNNING:
+            return get(row.id)
+
+
+def held(row):
+    # True while no other worker has taken the job over.
+    return and_(job.c.id == row.id, job.c.state == RUNNING,
+                job.c.attempts == row.attempts)
+
+
+def perform(row):
+    """Run the claimed job *row* and record how it went."""
+    try:
+        result = HANDLERS[row.kind](**json.loads(row.args))
+        finished = db_session.execute(job.update().where(held(row)).values(
+            state=DONE, finished=now(), result=json.dumps(result))).rowcount
+        if finished:
+            db_session.commit()
+        else:
+            db_session.rollback()
+        return
+    except Exception:
+        db_session.rollback()
+        error = traceback.format_exc()
+    values = dict(error=error, state=QUEUED, run_after=now() +
+                  datetime.timedelta(seconds=RETRY_DELAY * row.attempts))
+    if row.attempts >= MAX_ATTEMPTS:
+        values.update(state=FAILED, finished=now())
+    db_session.execute(job.update().where(held(row)).values(**values))
+    db_session.commit()
+
+
+def work_once():
+    """Run the next job that is due, returning False if there was none."""
+    row = claim()
+    if row is None:
+        return False
+    perform(row)
+    return True
+
+
+def work(db_uri, config):
+    from monkeyapp import create_app
+    app = create_app(db_uri, **config)
+    with app.app_context():
+        try:
+            while True:
+                if not work_once():
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            db_session.remove()
+
+
+def run_workers(db_uri, processes, config):
+    """Run jobs in *processes* worker processes, with the cache settings
+    in *config*, until interrupted."""
+    if per_process(config):
+        raise ValueError("Job workers need a shared CACHE_BACKEND")
+    workers = [multiprocessing.Process(target=work, args=(db_uri, config))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+
+def prune(retention_days=RETENTION_DAYS):
+    """Drop the jobs done or failed more than *retention_days* ago and
+    return how many there were."""
+    cutoff = now() - datetime.timedelta(days=retention_days)
+    pruned = db_session.execute(job.delete().where(and_(
+        job.c.state.in_([DONE, FAILED]), job.c.finished < cutoff))).rowcount
+    db_session.commit()
+    return pruned
+
+
+def job_dict(row):
+    return dict(
+        id=row.id, kind=row.kind, state=row.state, attempts=row.attempts,
+        created=row.created.isoformat(),
+        finished=row.finished.isoformat() if row.finished else None,
+        result=json.loads(row.result) if row.result is not None else None,
+        error=row.error)
+
+
+def accepted(row):
+    """Answer that the job *row* was queued, pointing at its status."""
+    response = jsonify(job=job_dict(row))
+    response.status_code = 202
+    response.headers['Location'] = url_for(
+        'jsonapi.job_status', ident=row.id)
+    return response
@@ -0,0 +1,153 @@
+from functools import wraps
+
+from flask import Blueprint, Response, request, jsonify, abort, current_app
+
+from monkeyapp import models, versions, recommendations, paths, search
+from monkeyapp import changes, jobs
+from monkeyapp.database import db_session
+from monkeyapp.models import User
+
+jsonapi = Blueprint('jsonapi', __name__, url_prefix='/api')
+
+
+def conditional(key_for):
+    """Answer with 304 when the client holds the current version.
+
+    The version is read before the view runs, so a write landing in
+    between can only make the response newer than its ETag.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            version, modified = versions.get(key_for(**kwargs))
+            etag = 'v%i' % version
+            if request.if_none_match:
+                fresh = request.if_none_match.contains(etag)
+            else:
+                since = request.if_modified_since
+                fresh = bool(since and modified and modified <= since)
+            if fresh:
+                response = Response(status=304)
+            else:
+                response = jsonify(view(**kwargs))
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            return response
+        return wrapper
+    return decorator
+
+
+def monkey_dict(row):
+    return dict(
+        id=row.id, name=row.name, email=row.email, age=row.age,
+        friend_count=row.friend_count,
+        best_friend=dict(id=row.best_friend_id, name=row.best_friend_name)
+        if row.best_friend_id else None)
+
+
+@jsonapi.route("/monkeys")
+@conditional(lambda: versions.GLOBAL)
+def monkeys():
+    order = request.args.get('ord')
+    try:
+        page = models.paginate_rows(
+            order=order, cursor=request.args.get('cursor'),
+            per_page=current_app.config['MONKEYS_PER_PAGE'])
+    except ValueError:
+        abort(400)
+    return dict(monkeys=[monkey_dict(row) for row in page],
+                next=page.next_cursor, prev=page.prev_cursor)
+
+
+@jsonapi.route("/monkeys/<int:ident>")
+@conditional(lambda ident: versions.monkey_key(ident))
+def monkey(ident):
+    row = models.query_rows().filter(User.id == ident).first()
+    if row is None:
+        abort(404)
+    return monkey_dict(models.MonkeyRow._make(row))
+
+
+@jsonapi.route("/monkeys/<int:ident>/friends")
+@conditional(lambda ident: versions.monkey_key(ident))
+def friends(ident):
+    if db_session.query(User.id).filter(User.id == ident).first() is None:
+        abort(404)
+    rows = (
+        db_session.query(User.id, User.name)
+        .filter(User.id.in_(models.friend_ids(ident)))
+        .order_by(User.name))
+    return dict(friends=[dict(id=i, name=name) for i, name in rows])
+
+
+@jsonapi.route("/monkeys/<int:ident>/recommendations")
+def monkey_recommendations(ident):
+    if db_session.query(User.id).filter(User.id == ident).first() is None:
+        abort(404)
+    limit = max(1, min(
+        request.args.get('limit', recommendations.LIMIT, type=int), 50))
+    rows, exact = recommendations.recommend(ident, limit)
+    return jsonify(exact=exact, recommendations=[
+        dict(id=i, name=name, mutual_friends=mutual)
+        for i, name, mutual in rows])
+
+
+@jsonapi.route("/monkeys/<int:ident>/path/<int:other>")
+def path(ident, other):
+    monkeys = User.query.filter(User.id.in_([ident, other])).all()
+    if len(monkeys) != len(set([ident, other])):
+        abort(404)
+    limits = dict(
+        max_depth=min(request.args.get('depth', paths.MAX_DEPTH, type=int),
+                      paths.MAX_DEPTH),
+        max_visited=min(request.args.get(
+            'visited', paths.MAX_VISITED, type=int), paths.MAX_VISITED))
+    try:
+        ids = paths.shortest_path(ident, other, **limits)
+    except paths.SearchLimitExceeded:
+        return jsonify(path=None, limited=True)
+    if ids is None:
+        return jsonify(path=None, limited=False)
+    names = dict(db_session.query(User.id, User.name)
+                 .filter(User.id.in_(ids)))
+    return jsonify(path=[dict(id=i, name=names[i]) for i in ids],
+                   degrees=len(ids) - 1)
+
+
+@jsonapi.route("/search")
+def search_monkeys():
+    limit = max(1, min(request.args.get('limit', search.LIMIT, type=int), 50))
+    rows = search.search(request.args.get('q', u''), limit)
+    return jsonify(results=[
+        dict(id=i, name=name, email=email) for i, name, email in rows])
+
+
+@jsonapi.route("/changes")
+def change_feed():
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', changes.BATCH, type=int),
+                changes.MAX_BATCH)
+    wait = min(request.args.get('wait', 0, type=float),
+               current_app.config.get('CHANGES_MAX_WAIT', changes.MAX_WAIT))
+    try:
+        rows = changes.poll(since, limit, wait)
+    except changes.Expired:
+        abort(410)
+    return jsonify(changes=[changes.change_dict(row) for row in rows],
+                   next=rows[-1].seq if rows else since)
+
+
+@jsonapi.route("/cache/stats")
+def cache_stats():
+    profiles = current_app.profiles
+    return jsonify(current_app.cache.stats, profiles=dict(
+        profiles.stats, hit_ratio=profiles.hit_ratio()))
+
+
+@jsonapi.route("/jobs/<int:ident>")
+def job_status(ident):
+    row = jobs.get(ident)
+    if row is None:
+        abort(404)
+    return jsonify(jobs.job_dict(row))
@@ -0,0 +1,253 @@
+import bisect
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, Response
+from sqlalchemy import event
+
+# Upper bounds in seconds of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Quantiles are computed over the requests of the last WINDOW seconds,
+# keeping at most WINDOW_SAMPLES of them per endpoint.
+WINDOW = 300
+WINDOW_SAMPLES = 10000
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Window(object):
+    def __init__(self):
+        self.samples = collections.deque(maxlen=WINDOW_SAMPLES)
+
+    def observe(self, value, now):
+        self.samples.append((now, value))
+
+    def quantiles(self, now):
+        while self.samples and self.samples[0][0] < now - WINDOW:
+            self.samples.popleft()
+        values = sorted(value for _, value in self.samples)
+        if not values:
+            return []
+        return [(q, values[min(int(q * len(values)), len(values) - 1)])
+                for q in QUANTILES]
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.statuses = collections.Counter()
+        self.latency = Histogram()
+        self.window = Window()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.slowest = (0.0, None)
+
+
+class Registry(object):
+    """Request and SQL statistics of this worker process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = collections.defaultdict(EndpointStats)
+
+    def record(self, endpoint, status, duration, queries, sql_seconds,
+               slowest):
+        now = time.time()
+        with self.lock:
+            stats = self.endpoints[endpoint]
+            stats.statuses[status] += 1
+            stats.latency.observe(duration)
+            stats.window.observe(duration, now)
+            stats.queries += queries
+            stats.sql_seconds += sql_seconds
+            if slowest[0] > stats.slowest[0]:
+                stats.slowest = slowest
+
+    def render(self, extra=()):
+        now = time.time()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append('%s%s{%s} %s' % (
+                    name, suffix, format_labels(labels), format_value(value)))
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            metric('monkeyapp_requests_total', 'counter',
+                   'Requests handled.', [
+                       ('', [('endpoint', e), ('status', status)], count)
+                       for e, stats in endpoints
+                       for status, count in sorted(stats.statuses.items())])
+            samples = []
+            for e, stats in endpoints:
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',),
+                                        stats.latency.buckets):
+                    cumulative += count
+                    samples.append(('_bucket', [('endpoint', e),
+                                                ('le', bound)], cumulative))
+                samples.append(('_sum', [('endpoint', e)], stats.latency.sum))
+                samples.append(
+                    ('_count', [('endpoint', e)], stats.latency.count))
+            metric('monkeyapp_request_duration_seconds', 'histogram',
+                   'Request latency.', samples)
+            samples = []
+            for e, stats in endpoints:
+                for q, value in stats.window.quantiles(now):
+                    samples.append(
+                        ('', [('endpoint', e), ('quantile', q)], value))
+            metric('monkeyapp_recent_request_duration_seconds', 'summary',
+                   'Request latency over the last %i seconds.' % WINDOW,
+                   samples)
+            metric('monkeyapp_sql_queries_total', 'counter',
+                   'SQL statements executed.', [
+                       ('', [('endpoint', e)], stats.queries)
+                       for e, stats in endpoints])
+            metric('monkeyapp_sql_seconds_total', 'counter',
+                   'Time spent executing SQL.', [
+                       ('', [('endpoint', e)], stats.sql_seconds)
+                       for e, stats in endpoints])
+            metric('monkeyapp_sql_slowest_seconds', 'gauge',
+                   'Slowest SQL statement seen.', [
+                       ('', [('endpoint', e)], stats.slowest[0])
+                       for e, stats in endpoints])
+            for e, stats in endpoints:
+                if stats.slowest[1] is not None:
+                    lines.append('# slowest statement of %s: %s' % (
+                        e, ' '.join(stats.slowest[1].split())))
+        for name, kind, help, samples in extra:
+            metric(name, kind, help, samples)
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    return ','.join('%s="%s"' % (name, format_label(value))
+                    for name, value in labels)
+
+
+def format_label(value):
+    if isinstance(value, float):
+        value = format_value(value)
+    return unicode(value).replace('\\', r'\\').replace(
+        '"', r'\"').replace('\n', r'\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries(app):
+    """Collect the statements *app* executes while the block runs."""
+    counter = QueryCounter()
+    app.query_counters.append(counter)
+    try:
+        yield counter
+    finally:
+        app.query_counters.remove(counter)
+
+
+@contextmanager
+def assert_max_queries(app, maximum):
+    with count_queries(app) as counter:
+        yield counter
+    if counter.count > maximum:
+        raise AssertionError("%i queries, expected at most %i:\n%s" % (
+            counter.count, maximum, '\n'.join(counter.statements)))
+
+
+def init_app(app):
+    app.metrics = Registry()
+    app.query_counters = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('query_start', []).append(time.time())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        duration = time.time() - conn.info['query_start'].pop()
+        for counter in app.query_counters:
+            counter.statements.append(statement)
+        if has_request_context() and hasattr(g, 'sql_queries'):
+            g.sql_queries += 1
+            g.sql_seconds += duration
+            if duration > g.sql_slowest[0]:
+                g.sql_slowest = (duration, statement)
+
+    def dbapi_error(conn, cursor, statement, parameters, context, exception):
+        conn.info['query_start'].pop()
+
+    for engine in [app.engine] + getattr(app, 'replicas', []):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(engine, 'dbapi_error', dbapi_error)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.time()
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+        g.sql_slowest = (0.0, None)
+
+    @app.after_request
+    def record(response):
+        if not hasattr(g, 'request_start'):
+            return response
+        app.metrics.record(
+            request.endpoint or 'unknown', response.status_code,
+            time.time() - g.request_start, g.sql_queries, g.sql_seconds,
+            g.sql_slowest)
+        # A streamed body runs its statements after this, so its count
+        # would be wrong.
+        if not response.is_streamed:
+            response.headers['X-Query-Count'] = str(g.sql_queries)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        extra = [
+            ('monkeyapp_cache_requests_total', 'counter',
+             'Fragment cache lookups.', [
+                 ('', [('kind', kind), ('result', result)], count)
+                 for kind, stats in sorted(app.cache.stats.items())
+                 for result, count in sorted(stats.items())]),
+            ('monkeyapp_profile_cache_requests_total', 'counter',
+             'Profile cache lookups by the tier that answered.', [
+                 ('', [('result', result)], count)
+                 for result, count in sorted(app.profiles.stats.items())]),
+            ('monkeyapp_startup_seconds', 'gauge',
+             'Time create_app took in this worker.', [
+                 ('', [], app.startup_seconds)]),
+            ('monkeyapp_warmup_seconds', 'gauge',
+             'Time each warm-up phase took.', [
+                 ('', [('phase', phase)], seconds)
+                 for phase, seconds in sorted(app.warmup_seconds.items())])]
+        return Response(app.metrics.render(extra),
+                        mimetype='text/plain; version=0.0.4')
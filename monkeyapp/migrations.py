@@ -0,0 +1,176 @@
+from flask import current_app
+from sqlalchemy import inspect, exists, select, and_
+
+from monkeyapp import search
+from monkeyapp.changes import change_event
+from monkeyapp.database import Base
+from monkeyapp.models import User, friendship, recount_friends_statement
+from monkeyapp.models import CANONICAL, NAME_PATTERN_INDEX
+from monkeyapp.recommendations import mutual_friend, mutual_friend_pending
+
+# Each migration takes an engine and must be safe to run again on a
+# database it has already been applied to.
+MIGRATIONS = []
+
+
+def migration(f):
+    MIGRATIONS.append(f)
+    return f
+
+
+def column_names(engine, table):
+    return set(column['name'] for column in inspect(engine).get_columns(table))
+
+
+def index_names(engine, table):
+    return set(index['name'] for index in inspect(engine).get_indexes(table))
+
+
+def create_missing_indexes(engine, table):
+    existing = index_names(engine, table.name)
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(bind=engine)
+
+
+@migration
+def add_friend_count(engine):
+    if 'friend_count' not in column_names(engine, 'user'):
+        engine.execute(
+            'ALTER TABLE "user" ADD COLUMN friend_count INTEGER '
+            'NOT NULL DEFAULT 0')
+        engine.execute(recount_friends_statement(canonical=False))
+    if 'ix_user_friend_count' in index_names(engine, 'user'):
+        engine.execute('DROP INDEX ix_user_friend_count')
+
+
+@migration
+def add_friendship_primary_key(engine):
+    pk = inspect(engine).get_pk_constraint('friendship')
+    if pk and pk.get('constrained_columns'):
+        return
+    # Not every backend can add a primary key in place, so the table is
+    # rebuilt from its distinct non-reflexive edges.
+    with engine.begin() as connection:
+        connection.execute('ALTER TABLE friendship RENAME TO friendship_old')
+        friendship.create(bind=connection)
+        connection.execute(
+            'INSERT INTO friendship (m1_id, m2_id) '
+            'SELECT DISTINCT m1_id, m2_id FROM friendship_old '
+            'WHERE m1_id IS NOT NULL AND m2_id IS NOT NULL '
+            'AND m1_id != m2_id')
+        connection.execute('DROP TABLE friendship_old')
+        connection.execute(recount_friends_statement(canonical=False))
+
+
+@migration
+def create_indexes(engine):
+    create_missing_indexes(engine, User.__table__)
+    create_missing_indexes(engine, friendship)
+
+
+@migration
+def create_name_pattern_index(engine):
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as connection:
+            connection.execute(NAME_PATTERN_INDEX)
+
+
+@migration
+def create_mutual_friends(engine):
+    # Monkeys with friends by now are counted by build-recommendations.
+    if mutual_friend.name in inspect(engine).get_table_names():
+        return
+    with engine.begin() as connection:
+        mutual_friend.create(bind=connection)
+        mutual_friend_pending.create(bind=connection)
+        connection.execute(mutual_friend_pending.insert().from_select(
+            ['monkey_id'],
+            select([User.id]).where(User.friend_count > 0)))
+
+
+@migration
+def create_tables(engine):
+    # Tables added since the first release, e.g. versions.data_version.
+    Base.metadata.create_all(bind=engine)
+
+
+@migration
+def create_trigram_indexes(engine):
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as connection:
+            search.create_trigram_indexes(connection)
+
+
+@migration
+def create_search_pattern_indexes(engine):
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as connection:
+            search.create_pattern_indexes(connection)
+
+
+@migration
+def number_changes_on_read(engine):
+    if 'id' in column_names(engine, 'change_event'):
+        return
+    # Events get an id of their own and their number once committed.
+    with engine.begin() as connection:
+        for name in index_names(engine, 'change_event'):
+            connection.execute('DROP INDEX %s' % name)
+        connection.execute(
+            'ALTER TABLE change_event RENAME TO change_event_old')
+        if engine.dialect.name == 'postgresql':
+            connection.execute('ALTER TABLE change_event_old '
+                               'DROP CONSTRAINT change_event_pkey')
+        change_event.create(bind=connection)
+        connection.execute(
+            'INSERT INTO change_event (id, seq, created, kind, subject, '
+            'monkey_id, other_id, data) SELECT seq, seq, created, kind, '
+            'subject, monkey_id, other_id, data FROM change_event_old')
+        connection.execute('DROP TABLE change_event_old')
+        if engine.dialect.name == 'postgresql':
+            connection.execute(
+                "SELECT setval(pg_get_serial_sequence('change_event', "
+                "'id'), max(id)) FROM change_event")
+
+
+def mirrored():
+    mirror = friendship.alias('mirror')
+    return exists().where(and_(mirror.c.m1_id == friendship.c.m2_id,
+                               mirror.c.m2_id == friendship.c.m1_id))
+
+
+def collapse_friendships(connection):
+    """Keep every friendship as one (lower id, higher id) row."""
+    connection.execute(friendship.delete().where(
+        and_(friendship.c.m1_id > friendship.c.m2_id, mirrored())))
+    # What is left above the diagonal has no mirror to collide with.
+    connection.execute(
+        friendship.update().where(friendship.c.m1_id > friendship.c.m2_id)
+        .values(m1_id=friendship.c.m2_id, m2_id=friendship.c.m1_id))
+
+
+def expand_friendships(connection):
+    """Store every friendship in both directions."""
+    connection.execute(friendship.insert().from_select(
+        ['m1_id', 'm2_id'],
+        select([friendship.c.m2_id, friendship.c.m1_id])
+        .where(~mirrored())))
+
+
+@migration
+def friendship_storage(engine):
+    # Rewrites the table to match FRIENDSHIP_STORAGE. Web workers still
+    # running with the other setting see wrong friend lists meanwhile.
+    canonical = current_app.config.get('FRIENDSHIP_STORAGE') == CANONICAL
+    with engine.begin() as connection:
+        if canonical:
+            collapse_friendships(connection)
+        else:
+            expand_friendships(connection)
+        connection.execute(recount_friends_statement(canonical))
+
+
+def upgrade(engine):
+    for step in MIGRATIONS:
+        step(engine)
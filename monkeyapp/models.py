@@ -1,14 +1,120 @@
+import collections
+import itertools
+
+from flask import current_app
 from wtforms.validators import Email
 from sqlalchemy import Column, Integer, String, ForeignKey, Table, func
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import select, exists, and_, or_, union_all
+from sqlalchemy import literal_column
+from sqlalchemy import Index, DDL, event
+from sqlalchemy.orm import relationship
 from sqlalchemy.orm import aliased
+from sqlalchemy.orm import joinedload, lazyload, noload, subqueryload
 
+from monkeyapp import pagination, versions
 from monkeyapp.database import Base, db_session
 
+# Upper bound on ids or id groups bound into one statement.
+EDGE_CHUNK = 400
+# Rows of a derived table, each a SELECT of a compound SELECT, which
+# SQLite limits to 500.
+ROWS_CHUNK = 200
+
 friendship = Table(
     'friendship', Base.metadata,
-    Column('m1_id', Integer, ForeignKey('user.id')),
-    Column('m2_id', Integer, ForeignKey('user.id')))
+    Column('m1_id', Integer, ForeignKey('user.id'), primary_key=True),
+    Column('m2_id', Integer, ForeignKey('user.id'), primary_key=True))
+# The primary key serves lookups by m1_id, this one lookups by m2_id.
+Index('ix_friendship_m2_m1', friendship.c.m2_id, friendship.c.m1_id)
+
+# FRIENDSHIP_STORAGE: 'symmetric' stores every friendship in both
+# directions, 'canonical' stores it once as (lower id, higher id).
+SYMMETRIC = 'symmetric'
+CANONICAL = 'canonical'
+
+
+def canonical_storage():
+    return current_app.config.get('FRIENDSHIP_STORAGE') == CANONICAL
+
+
+def canonical_pair(pair):
+    return min(pair), max(pair)
+
+
+def is_friend(m1_id, m2_id):
+    condition = and_(friendship.c.m1_id == m1_id, friendship.c.m2_id == m2_id)
+    if canonical_storage():
+        condition = or_(condition, and_(
+            friendship.c.m1_id == m2_id, friendship.c.m2_id == m1_id))
+    return exists().where(condition)
+
+
+def friend_ids(ident):
+    """Return a select of the ids of the friends of *ident*."""
+    if not canonical_storage():
+        return select([friendship.c.m2_id]).where(friendship.c.m1_id == ident)
+    return union_all(
+        select([friendship.c.m2_id]).where(friendship.c.m1_id == ident),
+        select([friendship.c.m1_id]).where(friendship.c.m2_id == ident))
+
+
+def edges(name='edges'):
+    """Return every friendship as directed (m1_id, m2_id) edges, one in
+    each direction, whichever way they are stored."""
+    if not canonical_storage():
+        return friendship.alias(name)
+    return union_all(
+        select([friendship.c.m1_id, friendship.c.m2_id]),
+        select([friendship.c.m2_id.label('m1_id'),
+                friendship.c.m1_id.label('m2_id')])).alias(name)
+
+
+def adjacency(ids):
+    """Return a dict mapping each of *ids* to the set of its friends."""
+    friends = dict((ident, set()) for ident in ids)
+    queries = [(friendship.c.m1_id, friendship.c.m2_id)]
+    if canonical_storage():
+        queries.append((friendship.c.m2_id, friendship.c.m1_id))
+    for chunk in chunks(friends, EDGE_CHUNK):
+        for m1_id, m2_id in queries:
+            for a, b in db_session.execute(
+                    select([m1_id, m2_id]).where(m1_id.in_(chunk))):
+                friends[a].add(b)
+    return friends
+
+
+# Called with (pairs, 1) after friendships were added and (pairs, -1)
+# after they were removed, in the same transaction.
+friendship_listeners = []
+
+
+def on_friendships_changed(listener):
+    friendship_listeners.append(listener)
+    return listener
+
+
+# Called with the ids of the monkeys whose best friend links were
+# cleared in bulk, in the same transaction.
+best_friend_listeners = []
+
+
+def on_best_friends_cleared(listener):
+    best_friend_listeners.append(listener)
+    return listener
+
+
+def clear_best_friends(condition):
+    """Clear the best friend links of the monkeys matching *condition*."""
+    user = User.__table__
+    ids = [ident for ident, in
+           db_session.execute(select([user.c.id]).where(condition))]
+    if not ids:
+        return
+    for chunk in chunks(ids, EDGE_CHUNK):
+        db_session.execute(user.update().where(user.c.id.in_(chunk))
+                           .values(best_friend_id=None))
+    for listener in best_friend_listeners:
+        listener(ids)
 
 
 class User(Base):
@@ -19,85 +125,492 @@ class User(Base):
         String(120), unique=True, nullable=False,
         info={'validators': [Email()]})
     age = Column(Integer(), info={'min': 0})
+    # Number of friends, kept in step with the friendship table by the
+    # mutation methods below.
+    friend_count = Column(
+        Integer, nullable=False, default=0, server_default='0')
 
-    best_friend_id = Column(Integer, ForeignKey('user.id'))
+    best_friend_id = Column(Integer, ForeignKey('user.id'), index=True)
+    # Loaded on access unless a query picks another strategy, see
+    # BEST_FRIEND_LOADERS.
     best_friend = relationship(
-        lambda: User, remote_side=[id],
-        order_by=lambda: User.name, lazy='joined')
-    friends = relationship(
-        'User',
-        secondary=friendship,
-        primaryjoin=id == friendship.c.m1_id,
-        secondaryjoin=id == friendship.c.m2_id,
-        backref=backref('ofriends', lazy='dynamic'),
-        lazy='dynamic')
+        lambda: User, remote_side=[id], order_by=lambda: User.name)
+
+    @property
+    def friends(self):
+        return User.query.filter(User.id.in_(friend_ids(self.id)))
+
+    @property
+    def ofriends(self):
+        # Monkeys listing self as a friend, the same ones as self lists.
+        return self.friends
 
     def add_friend(self, other):
-        if self != other:
-            if other not in self.friends:
-                self.friends.append(other)
-            if self not in other.friends:
-                other.friends.append(self)
-        db_session.flush()
+        self.add_friends([other.id])
 
     def remove_friend(self, other):
-        if other.best_friend == self:
-            other.best_friend = None
-            # Needed to avoid sqlalchemy.exc.CircularDependencyError
-            db_session.flush()
-        if self.best_friend == other:
-            self.best_friend = None
-        if self not in other.friends:
+        if not self.remove_friends([other.id]):
             raise Exception
-        self.friends.remove(other)
-        other.friends.remove(self)
+
+    def add_friends(self, ids):
+        """Befriend every monkey in *ids* and return the ids that were new.
+
+        Unknown ids, existing friends and self are skipped.
+        """
         db_session.flush()
+        added = add_friendships([(self.id, ident) for ident in ids])
+        expire_users([self.id] + [ident for _, ident in added])
+        return [ident for _, ident in added]
+
+    def remove_friends(self, ids):
+        """Unfriend every monkey in *ids* and return the ids removed.
+
+        Best friend links between self and a removed friend are cleared.
+        """
+        db_session.flush()
+        removed = remove_friendships([(self.id, ident) for ident in ids])
+        expire_users([self.id] + [ident for _, ident in removed])
+        return [ident for _, ident in removed]
 
     def get_non_friends(self):
-        return User.query.except_(self.friends).filter(User.id != self.id)
+        return non_friends(self.id)
+
+    def has_non_friends(self):
+        return has_non_friends(self.id)
+
+    def search_non_friends(self, prefix, limit=10):
+        query = self.get_non_friends().with_entities(User.id, User.name)
+        if prefix:
+            query = query.filter(
+                User.name.like(escape_like(prefix) + u'%', escape='\\'))
+        return query.order_by(User.name).limit(limit)
 
     def make_best_friend(self, other):
-        if other not in self.friends:
+        if not db_session.query(is_friend(self.id, other.id)).scalar():
             raise Exception
         self.best_friend = other
+        versions.bump([self.id])
+        db_session.flush()
+
+    def path_to(self, other, **limits):
+        """Return the monkeys on a shortest chain of friends from self to
+        *other*, None if they are not connected within the limits of
+        paths.shortest_path."""
+        from monkeyapp import paths
+        ids = paths.shortest_path(self.id, other.id, **limits)
+        if ids is None:
+            return None
+        monkeys = dict((monkey.id, monkey) for monkey in
+                       User.query.filter(User.id.in_(ids)))
+        return [monkeys[ident] for ident in ids]
+
+    def touch(self):
+        """Bump the version of self and of every monkey showing it."""
+        ids = [ident for ident, in db_session.execute(friend_ids(self.id))]
+        ids += [ident for ident, in db_session.query(User.id)
+                .filter(User.best_friend_id == self.id)]
+        versions.bump([self.id] + ids)
+
+    def delete(self):
+        self.touch()
+        self.remove_friends(
+            [ident for ident, in db_session.execute(friend_ids(self.id))])
+        clear_best_friends(User.best_friend_id == self.id)
+        db_session.delete(self)
         db_session.flush()
 
     def __init__(self, name, email, age):
         self.name = name
         self.email = email
         self.age = age
+        self.friend_count = 0
 
     def __repr__(self):
         return '<User %r>' % self.name
 
 
-def query_users(order=None):
-    best_friend_alias = aliased(User, name="bfalias")
+def escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_')
+
+
+def non_friends(ident):
+    return User.query.filter(User.id != ident, ~is_friend(ident, User.id))
+
+
+def has_non_friends(ident):
+    return db_session.query(non_friends(ident).exists()).scalar()
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def unique_pairs(pairs):
+    """Drop self links and repeats of a pair in either direction."""
+    seen, unique = set(), []
+    for m1_id, m2_id in pairs:
+        if m1_id != m2_id and (m2_id, m1_id) not in seen and \
+                (m1_id, m2_id) not in seen:
+            seen.add((m1_id, m2_id))
+            unique.append((m1_id, m2_id))
+    return unique
+
+
+def group_pairs(pairs):
+    groups = {}
+    for m1_id, m2_id in pairs:
+        groups.setdefault(m1_id, set()).add(m2_id)
+    return groups
+
+
+def edge_conditions(pairs, table=friendship):
+    """Yield WHERE clauses matching *pairs* in the m1_id and m2_id
+    columns of *table*, grouped by their first id.
+
+    Clauses are chunked to stay within SQLite's expression depth limit.
+    """
+    for groups in chunks(group_pairs(pairs).items(), EDGE_CHUNK):
+        clauses = []
+        for m1_id, m2_ids in groups:
+            clauses.append(and_(table.c.m1_id == m1_id,
+                                table.c.m2_id.in_(m2_ids)))
+        yield or_(*clauses)
+
+
+def stored_pairs(pairs):
+    """Return the rows storing the friendships in *pairs*."""
+    if canonical_storage():
+        return [canonical_pair(pair) for pair in pairs]
+    return pairs + [(b, a) for a, b in pairs]
+
+
+def existing_friendships(pairs):
+    # Symmetric storage has both directions, so looking up one is enough.
+    keys = pairs
+    if canonical_storage():
+        keys = [canonical_pair(pair) for pair in pairs]
+    found = set()
+    for condition in edge_conditions(keys):
+        found.update(
+            tuple(row) for row in db_session.execute(
+                select([friendship.c.m1_id, friendship.c.m2_id])
+                .where(condition)))
+    return [pair for pair, key in zip(pairs, keys) if key in found]
+
+
+def shift_friend_counts(pairs, sign):
+    deltas = collections.Counter()
+    for m1_id, m2_id in pairs:
+        deltas[m1_id] += sign
+        deltas[m2_id] += sign
+    by_delta = {}
+    for ident, delta in deltas.items():
+        by_delta.setdefault(delta, []).append(ident)
+    user = User.__table__
+    for delta, ids in by_delta.items():
+        for chunk in chunks(ids, EDGE_CHUNK):
+            db_session.execute(
+                user.update().where(user.c.id.in_(chunk))
+                .values(friend_count=user.c.friend_count + delta))
+
+
+def int_rows(rows, names, name):
+    """Return *rows* of integers as a derived table with the columns
+    *names*. The numbers are written into the statement, so a statement
+    joining it binds no parameters however many rows there are."""
+    selects = [select([literal_column('%i' % value).label(column)
+                       for value, column in zip(row, names)])
+               for row in rows]
+    if len(selects) == 1:
+        return selects[0].alias(name)
+    return union_all(*selects).alias(name)
+
+
+class SkippedRows(Exception):
+    pass
+
+
+def insert_new_edges(rows):
+    new = int_rows(rows, ('m1_id', 'm2_id'), 'new')
+    stored = exists().where(and_(friendship.c.m1_id == new.c.m1_id,
+                                 friendship.c.m2_id == new.c.m2_id))
+    return friendship.insert().from_select(
+        ['m1_id', 'm2_id'],
+        select([new.c.m1_id, new.c.m2_id]).where(~stored))
+
+
+def insert_edges(rows):
+    """Store the (m1_id, m2_id) *rows* that are not stored yet and return
+    the ones inserted.
+
+    The insert checks for each row itself, so a direction left by a half
+    written friendship or just added by another transaction is skipped
+    instead of breaking the primary key.
+    """
+    inserted = []
+    returning = current_app.engine.dialect.name == 'postgresql'
+    for chunk in chunks(rows, ROWS_CHUNK):
+        if returning:
+            inserted.extend(tuple(row) for row in db_session.execute(
+                insert_new_edges(chunk).returning(
+                    friendship.c.m1_id, friendship.c.m2_id)))
+            continue
+        # Without RETURNING, a chunk that skipped rows is undone and
+        # inserted again a row at a time, to tell them by the row count.
+        try:
+            with db_session.begin_nested():
+                if db_session.execute(
+                        insert_new_edges(chunk)).rowcount < len(chunk):
+                    raise SkippedRows
+            inserted.extend(chunk)
+        except SkippedRows:
+            inserted.extend(row for row in chunk if db_session.execute(
+                insert_new_edges([row])).rowcount)
+    return inserted
+
+
+def lock_users(ids):
+    """Lock the rows of the monkeys in *ids* until the transaction ends
+    and return the ids that exist.
+
+    The rows are locked in id order, so friendship writes sharing a
+    monkey run one after the other without deadlocking, and each counts
+    friends and mutual friends with the other's friendships in view.
+    """
+    known = set()
+    for chunk in chunks(sorted(ids), EDGE_CHUNK):
+        known.update(ident for ident, in
+                     db_session.query(User.id).filter(User.id.in_(chunk))
+                     .order_by(User.id).with_for_update())
+    return known
+
+
+def add_friendships(pairs):
+    """Befriend every (m1_id, m2_id) pair and return the pairs that were new.
+
+    Self links, duplicates, unknown ids and existing friendships are
+    skipped. Pairs sharing their first id are handled by one statement.
+    """
+    pairs = unique_pairs(pairs)
+    ids = set(ident for pair in pairs for ident in pair)
+    if not ids:
+        return []
+    known = lock_users(ids)
+    pairs = [(a, b) for a, b in pairs if a in known and b in known]
+    existing = set(existing_friendships(pairs))
+    new = [pair for pair in pairs if pair not in existing]
+    # Only pairs whose row this transaction stored are counted, not ones
+    # another transaction stored since they were looked up.
+    inserted = set(insert_edges(stored_pairs(new)))
+    if canonical_storage():
+        new = [pair for pair in new if canonical_pair(pair) in inserted]
+    else:
+        new = [pair for pair in new if pair in inserted]
+    shift_friend_counts(new, 1)
+    if new:
+        for listener in friendship_listeners:
+            listener(new, 1)
+        versions.bump(ident for pair in new for ident in pair)
+    return new
+
+
+def remove_friendships(pairs):
+    """Unfriend every (m1_id, m2_id) pair and return the pairs removed.
+
+    Best friend links along a removed friendship are cleared.
+    """
+    pairs = unique_pairs(pairs)
+    lock_users(set(ident for pair in pairs for ident in pair))
+    pairs = existing_friendships(pairs)
+    if not pairs:
+        return []
+    user = User.__table__
+    for groups in chunks(group_pairs(pairs).items(), EDGE_CHUNK):
+        clauses = []
+        for m1_id, m2_ids in groups:
+            clauses.append(and_(user.c.id == m1_id,
+                                user.c.best_friend_id.in_(m2_ids)))
+            clauses.append(and_(user.c.best_friend_id == m1_id,
+                                user.c.id.in_(m2_ids)))
+        clear_best_friends(or_(*clauses))
+    for condition in edge_conditions(stored_pairs(pairs)):
+        db_session.execute(friendship.delete().where(condition))
+    shift_friend_counts(pairs, -1)
+    for listener in friendship_listeners:
+        listener(pairs, -1)
+    versions.bump(ident for pair in pairs for ident in pair)
+    return pairs
+
+
+def expire_users(ids):
+    """Expire counters and best friend links that were changed in bulk."""
+    ids = set(ids)
+    for obj in list(db_session.identity_map.values()):
+        if isinstance(obj, User) and obj.id in ids:
+            db_session.expire(
+                obj, ['friend_count', 'best_friend_id', 'best_friend'])
+
+
+# name and email are indexed through their unique constraints. The list
+# view sorts on (age, id) and (friend_count, id).
+Index('ix_user_age_id', User.age, User.id)
+Index('ix_user_friend_count_id', User.friend_count, User.id)
+# Prefix LIKE on name only uses an index on PostgreSQL with the pattern
+# operators, whatever the collation.
+NAME_PATTERN_INDEX = DDL(
+    'CREATE INDEX IF NOT EXISTS ix_user_name_pattern '
+    'ON "user" (name text_pattern_ops)')
+event.listen(User.__table__, 'after_create',
+             NAME_PATTERN_INDEX.execute_if(dialect='postgresql'))
+
+
+best_friend_alias = aliased(User, name="bfalias")
+
+# Sort key -> (column, nullable)
+ORDERS = {
+    'name': (User.name, False),
+    'email': (User.email, False),
+    'age': (User.age, True),
+    'bf': (best_friend_alias.name, True),
+    'friends': (User.friend_count, False),
+}
+
+
+def parse_order(order):
+    descending = bool(order) and order.startswith('-')
+    key = order[1:] if descending else order
+    if key in ORDERS:
+        return key, descending
+    return None, False
+
+
+# Loading strategies for User.best_friend, picked per query.
+BEST_FRIEND_LOADERS = {
+    'joined': joinedload,
+    'select': lazyload,
+    'subquery': subqueryload,
+    'noload': noload,
+}
+
+# Rows for rendering, read from the columns without building entities,
+# so they skip the identity map and change tracking.
+MonkeyRow = collections.namedtuple('MonkeyRow', [
+    'id', 'name', 'email', 'age', 'friend_count',
+    'best_friend_id', 'best_friend_name'])
+FriendRow = collections.namedtuple('FriendRow', ['id', 'name'])
+
+
+def load_best_friend(query, strategy):
+    return query.options(BEST_FRIEND_LOADERS[strategy](User.best_friend))
+
+
+def sort(query, order):
+    key, descending = parse_order(order)
+    if key is not None:
+        column = ORDERS[key][0]
+        query = query.order_by(column.desc() if descending else column)
+    return query
+
+
+def query_users(order=None, best_friend='select'):
     query = (
         db_session.query(
-            User, func.count(friendship.c.m1_id),
+            User, User.friend_count,
             best_friend_alias.id, best_friend_alias.name)
-        .outerjoin(friendship, User.id == friendship.c.m1_id)
-        .outerjoin((best_friend_alias, User.best_friend))
-        .group_by(User, best_friend_alias))
-    if order == 'name':
-        query = query.order_by(User.name)
-    elif order == '-name':
-        query = query.order_by(User.name.desc())
-    elif order == 'email':
-        query = query.order_by(User.email)
-    elif order == '-email':
-        query = query.order_by(User.email.desc())
-    elif order == 'age':
-        query = query.order_by(User.age)
-    elif order == '-age':
-        query = query.order_by(User.age.desc())
-    elif order == 'bf':
-        query = query.order_by(best_friend_alias.name)
-    elif order == '-bf':
-        query = query.order_by(best_friend_alias.name.desc())
-    elif order == 'friends':
-        query = query.order_by(func.count(friendship.c.m1_id))
-    elif order == '-friends':
-        query = query.order_by(func.count(friendship.c.m1_id).desc())
-    return query
+        .outerjoin((best_friend_alias, User.best_friend)))
+    return sort(load_best_friend(query, best_friend), order)
+
+
+def query_rows(order=None):
+    """Like query_users, selecting the columns of MonkeyRow."""
+    query = (
+        db_session.query(
+            User.id, User.name, User.email, User.age, User.friend_count,
+            best_friend_alias.id, best_friend_alias.name)
+        .outerjoin(best_friend_alias,
+                   User.best_friend_id == best_friend_alias.id))
+    return sort(query, order)
+
+
+def check_page(order, cursor):
+    """Raise ValueError for arguments paginate would reject, without
+    reading anything."""
+    key, _ = parse_order(order)
+    if cursor is not None:
+        pagination.check_cursor(cursor, order if key else None)
+
+
+def paginate(query, order, cursor, per_page, row_type=tuple):
+    key, descending = parse_order(order)
+    column, nullable = ORDERS.get(key, (None, False))
+    return pagination.paginate(
+        query, order if key else None, column, User.id,
+        descending=descending, nullable=nullable,
+        cursor=cursor, per_page=per_page, row_type=row_type)
+
+
+def paginate_users(order=None, cursor=None, per_page=50,
+                   best_friend='select'):
+    return paginate(query_users(best_friend=best_friend), order, cursor,
+                    per_page)
+
+
+def paginate_rows(order=None, cursor=None, per_page=50):
+    """Return a page of MonkeyRows, read in one statement."""
+    return paginate(query_rows(), order, cursor, per_page, MonkeyRow._make)
+
+
+def friend_rows(ident):
+    return [FriendRow._make(row) for row in
+            db_session.query(User.id, User.name)
+            .filter(User.id.in_(friend_ids(ident))).order_by(User.name)]
+
+
+def counted_friends(canonical=None):
+    """Return the number of friends in the table of each user row, stored
+    canonically or symmetrically as configured unless *canonical* says
+    otherwise."""
+    if canonical is None:
+        canonical = canonical_storage()
+    user = User.__table__
+
+    def rows(column):
+        return (select([func.count()]).select_from(friendship)
+                .where(column == user.c.id).as_scalar())
+    count = rows(friendship.c.m1_id)
+    if canonical:
+        count = count + rows(friendship.c.m2_id)
+    return count
+
+
+def recount_friends_statement(canonical=None):
+    """Return an update setting every friend count to the number of
+    friends in the table."""
+    user = User.__table__
+    count = counted_friends(canonical)
+    return (
+        user.update()
+        .where(user.c.friend_count != count)
+        .values(friend_count=count))
+
+
+def recount_friends():
+    """Repair the friend counts that are wrong and return how many were,
+    bumping the versions of those monkeys."""
+    user = User.__table__
+    count = counted_friends()
+    ids = [ident for ident, in db_session.execute(
+        select([user.c.id]).where(user.c.friend_count != count))]
+    for chunk in chunks(ids, EDGE_CHUNK):
+        db_session.execute(user.update().where(user.c.id.in_(chunk))
+                           .values(friend_count=count))
+    if ids:
+        expire_users(ids)
+        versions.bump(ids)
+    return len(ids)
@@ -0,0 +1,109 @@
+import base64
+import json
+
+from sqlalchemy import and_, or_
+
+
+class Page(object):
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(order, direction, value, ident):
+    return base64.urlsafe_b64encode(
+        json.dumps([order, direction, value, ident]))
+
+
+def decode_cursor(cursor):
+    try:
+        order, direction, value, ident = json.loads(
+            base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if direction not in ('next', 'prev') or not isinstance(ident, int):
+        raise ValueError("Invalid cursor")
+    return order, direction, value, ident
+
+
+def check_cursor(cursor, order):
+    """Decode *cursor*, raising ValueError unless it is for *order*."""
+    cursor_order, direction, value, ident = decode_cursor(cursor)
+    if cursor_order != order:
+        raise ValueError("Cursor does not match order")
+    return direction, value, ident
+
+
+def order_by(query, key, ident, descending, nullable):
+    # Nulls sort last ascending and first descending so that one index
+    # scanned in either direction serves both the page and its reverse.
+    if key is None:
+        return query.order_by(ident.desc() if descending else ident)
+    if descending:
+        key = key.desc().nullsfirst() if nullable else key.desc()
+        return query.order_by(key, ident.desc())
+    key = key.asc().nullslast() if nullable else key
+    return query.order_by(key, ident)
+
+
+def seek_condition(key, ident, value, last_ident, descending, nullable):
+    if key is None:
+        return ident < last_ident if descending else ident > last_ident
+    if descending:
+        if value is None:
+            return or_(key.isnot(None),
+                       and_(key.is_(None), ident < last_ident))
+        return or_(key < value, and_(key == value, ident < last_ident))
+    if value is None:
+        return and_(key.is_(None), ident > last_ident)
+    condition = or_(key > value, and_(key == value, ident > last_ident))
+    if nullable:
+        condition = or_(condition, key.is_(None))
+    return condition
+
+
+def paginate(query, order, key, ident, descending=False, nullable=False,
+             cursor=None, per_page=50, row_type=tuple):
+    """Keyset paginate *query* sorted by *key* with *ident* as tiebreaker.
+
+    Rows are read as ``(row..., key value, ident value)`` and returned as
+    *row_type* built from ``row``.
+    """
+    direction = 'next'
+    if cursor is not None:
+        direction, value, last_ident = check_cursor(cursor, order)
+        backwards = direction == 'prev'
+        condition = seek_condition(
+            key, ident, value, last_ident, descending != backwards, nullable)
+        query = query.filter(condition)
+    backwards = direction == 'prev'
+    if key is not None:
+        query = query.add_columns(key)
+    query = query.add_columns(ident)
+    query = order_by(query, key, ident, descending != backwards, nullable)
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    width = 2 if key is not None else 1
+
+    def make_cursor(row, direction):
+        value = row[-2] if key is not None else None
+        return encode_cursor(order, direction, value, row[-1])
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if more or backwards:
+            next_cursor = make_cursor(rows[-1], 'next')
+        if (more and backwards) or (cursor is not None and not backwards):
+            prev_cursor = make_cursor(rows[0], 'prev')
+    return Page([row_type(tuple(row)[:-width]) for row in rows],
+                next_cursor, prev_cursor)
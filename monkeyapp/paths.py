@@ -0,0 +1,302 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from flask import current_app, has_app_context
+from sqlalchemy import Integer, select, literal, cast, null, and_, or_
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from monkeyapp.database import db_session
+from monkeyapp.models import edges, existing_friendships
+from monkeyapp.models import on_friendships_changed
+
+# A search gives up beyond MAX_DEPTH friendships or after reaching
+# MAX_VISITED monkeys.
+MAX_DEPTH = 6
+MAX_VISITED = 100000
+# The index is rebuilt in the background once it is older than
+# PATH_INDEX_MAX_AGE seconds (it only sees this worker's writes) or has
+# INDEX_MAX_CHANGES changes on top of it.
+INDEX_MAX_CHANGES = 100000
+
+
+class SearchLimitExceeded(Exception):
+    pass
+
+
+class FriendIndex(object):
+    """Friend lists of every monkey in compressed sparse row arrays, with
+    the friendships added and removed since they were built on top.
+
+    The friends of ids[i] are targets[offsets[i]:offsets[i + 1]], sorted.
+    """
+
+    def __init__(self, ids, offsets, targets):
+        self.ids = ids
+        self.offsets = offsets
+        self.targets = targets
+        self.added = {}
+        self.removed = set()
+        self.changes = 0
+        self.built = time.time()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        edge = edges()
+        rows = db_session.execute(
+            select([edge.c.m1_id, edge.c.m2_id])
+            .order_by(edge.c.m1_id, edge.c.m2_id)
+            .execution_options(stream_results=True))
+        ids, offsets, targets = array('i'), array('i'), array('i')
+        for m1_id, m2_id in rows:
+            if not ids or ids[-1] != m1_id:
+                ids.append(m1_id)
+                offsets.append(len(targets))
+            targets.append(m2_id)
+        offsets.append(len(targets))
+        return cls(ids, offsets, targets)
+
+    def stored(self, ident):
+        i = bisect_left(self.ids, ident)
+        if i == len(self.ids) or self.ids[i] != ident:
+            return ()
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def stored_edge(self, a, b):
+        row = self.stored(a)
+        i = bisect_left(row, b)
+        return i < len(row) and row[i] == b
+
+    def neighbours(self, ident):
+        with self.lock:
+            row = self.stored(ident)
+            if self.removed:
+                row = [other for other in row
+                       if (ident, other) not in self.removed]
+            added = self.added.get(ident)
+            if added:
+                row = list(row) + list(added)
+            return row
+
+    def apply(self, pairs, sign):
+        with self.lock:
+            for a, b in pairs:
+                for x, y in ((a, b), (b, a)):
+                    if sign > 0:
+                        self.removed.discard((x, y))
+                        if not self.stored_edge(x, y):
+                            self.added.setdefault(x, set()).add(y)
+                    else:
+                        self.added.get(x, set()).discard(y)
+                        if self.stored_edge(x, y):
+                            self.removed.add((x, y))
+            self.changes += len(pairs)
+
+    def stale(self, max_age):
+        return (self.changes > INDEX_MAX_CHANGES or
+                time.time() - self.built > max_age)
+
+
+def init_index(app):
+    if not hasattr(app, 'friend_index_lock'):
+        app.friend_index = None
+        # Changes committed while an index is loading, None otherwise.
+        app.friend_index_backlog = None
+        app.friend_index_lock = threading.Lock()
+
+
+def load_index(app):
+    """Build the friend index of *app* and swap it in."""
+    init_index(app)
+    try:
+        with app.app_context():
+            try:
+                index = FriendIndex.load()
+            finally:
+                db_session.remove()
+    except Exception:
+        with app.friend_index_lock:
+            app.friend_index_backlog = None
+        raise
+    with app.friend_index_lock:
+        # Writes committed while loading may or may not be in the
+        # snapshot; applying them again is harmless.
+        for pairs, sign in app.friend_index_backlog or ():
+            index.apply(pairs, sign)
+        app.friend_index = index
+        app.friend_index_backlog = None
+    return index
+
+
+def get_index(app):
+    """Return the friend index of *app*, None while it is first loaded.
+
+    A missing or stale index is loaded in a background thread.
+    """
+    if not app.config.get('PATH_INDEX', True):
+        return None
+    init_index(app)
+    index = app.friend_index
+    max_age = app.config.get('PATH_INDEX_MAX_AGE', 600)
+    if index is None or index.stale(max_age):
+        with app.friend_index_lock:
+            if app.friend_index_backlog is None:
+                app.friend_index_backlog = []
+                thread = threading.Thread(target=load_index, args=(app,))
+                thread.daemon = True
+                thread.start()
+    return index
+
+
+@on_friendships_changed
+def remember(pairs, sign):
+    db_session().info.setdefault('friendships', []).append((pairs, sign))
+
+
+@event.listens_for(Session, 'after_commit')
+def update_index(session):
+    changes = session.info.pop('friendships', None)
+    if not changes or not has_app_context():
+        return
+    app = current_app._get_current_object()
+    if not hasattr(app, 'friend_index_lock'):
+        return
+    with app.friend_index_lock:
+        for pairs, sign in changes:
+            if app.friend_index is not None:
+                app.friend_index.apply(pairs, sign)
+            if app.friend_index_backlog is not None:
+                app.friend_index_backlog.append((pairs, sign))
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget(session):
+    session.info.pop('friendships', None)
+
+
+def walk(parents, node):
+    path = []
+    while node is not None:
+        path.append(node)
+        node = parents[node]
+    return path
+
+
+def bidirectional_bfs(neighbours, source, target, max_depth=MAX_DEPTH,
+                      max_visited=MAX_VISITED):
+    """Return a shortest path of ids from *source* to *target*, None if
+    there is none within *max_depth* friendships."""
+    if source == target:
+        return [source]
+    parents = ({source: None}, {target: None})
+    depths = ({source: 0}, {target: 0})
+    frontiers = ([source], [target])
+    depth, visited = 0, 2
+    while frontiers[0] and frontiers[1] and depth < max_depth:
+        side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        mine, theirs = parents[side], parents[1 - side]
+        level, meetings = [], []
+        for node in frontiers[side]:
+            for other in neighbours(node):
+                if other in mine:
+                    continue
+                mine[other] = node
+                depths[side][other] = depths[side][node] + 1
+                if other in theirs:
+                    meetings.append(other)
+                level.append(other)
+                visited += 1
+                if visited > max_visited:
+                    raise SearchLimitExceeded
+        if meetings:
+            # Every meeting is one level deep on this side, so the
+            # nearest to the other side gives a shortest path.
+            meeting = min(meetings, key=depths[1 - side].get)
+            path = walk(parents[0], meeting)[::-1] + \
+                walk(parents[1], meeting)[1:]
+            return path
+        frontiers = list(frontiers)
+        frontiers[side] = level
+        depth += 1
+    return None
+
+
+def reach(source, max_depth, limit):
+    """Return {id: (depth, parent)} for the monkeys within *max_depth*
+    friendships of *source*, through a recursive CTE."""
+    edge = edges('step')
+    start = select([
+        cast(literal(source), Integer).label('id'),
+        cast(literal(0), Integer).label('depth'),
+        cast(null(), Integer).label('parent')])
+    found = start.cte('reach', recursive=True)
+    previous = found.alias('previous')
+    # UNION drops repeated (id, depth, parent) rows, which bounds the
+    # walks; not stepping straight back prunes most of the rest.
+    found = found.union(
+        select([edge.c.m2_id, previous.c.depth + 1, previous.c.id])
+        .where(and_(edge.c.m1_id == previous.c.id,
+                    previous.c.depth < max_depth,
+                    or_(previous.c.parent.is_(None),
+                        edge.c.m2_id != previous.c.parent))))
+    rows = db_session.execute(
+        select([found.c.id, found.c.depth, found.c.parent])
+        .limit(limit + 1)).fetchall()
+    if len(rows) > limit:
+        raise SearchLimitExceeded
+    # The parent on the shallowest row is itself one level shallower.
+    nearest = {}
+    for ident, depth, parent in rows:
+        if ident not in nearest or depth < nearest[ident][0]:
+            nearest[ident] = (depth, parent)
+    return nearest
+
+
+def sql_path(source, target, max_depth=MAX_DEPTH, max_visited=MAX_VISITED):
+    """Like bidirectional_bfs, searching from both ends in SQL."""
+    if source == target:
+        return [source]
+    forward = reach(source, (max_depth + 1) // 2, max_visited // 2)
+    backward = reach(target, max_depth // 2, max_visited // 2)
+    meetings = [ident for ident in forward if ident in backward]
+    if not meetings:
+        return None
+    meeting = min(meetings,
+                  key=lambda ident: forward[ident][0] + backward[ident][0])
+
+    def walk_back(found, node):
+        path = []
+        while node is not None:
+            path.append(node)
+            node = found[node][1]
+        return path
+    return walk_back(forward, meeting)[::-1] + \
+        walk_back(backward, meeting)[1:]
+
+
+def shortest_path(source, target, max_depth=MAX_DEPTH,
+                  max_visited=MAX_VISITED):
+    """Return a path of monkey ids between *source* and *target*, None
+    if there is none within *max_depth* friendships.
+
+    The path comes from the friend index when it has one. The index
+    misses other workers' recent writes, so such a path may be longer
+    than the shortest by friendships added since; the SQL search, used
+    otherwise, returns a shortest one.
+
+    Raises SearchLimitExceeded after reaching *max_visited* monkeys.
+    """
+    index = get_index(current_app._get_current_object())
+    if index is not None:
+        path = bidirectional_bfs(index.neighbours, source, target,
+                                 max_depth, max_visited)
+        # A path the index finds is checked, since a friendship on it
+        # may be gone, and no path there may only mean missing ones.
+        if path is not None:
+            pairs = zip(path, path[1:])
+            if len(existing_friendships(pairs)) == len(pairs):
+                return path
+    return sql_path(source, target, max_depth, max_visited)
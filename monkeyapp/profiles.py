@@ -0,0 +1,158 @@
+"""Monkey profiles cached by id across requests and workers.
+
+A profile holds what the profile and confirmation pages show of a
+monkey: its columns, its best friend and the ids of its friends. They
+are kept in an in-process LRU (``PROFILE_CACHE_SIZE`` entries) and, with
+``PROFILE_CACHE_BACKEND`` set to one of the cache backends, in a shared
+one that the workers read each other's loads from.
+
+Every entry carries the monkey's version, read in the statement that
+loaded it. Cached entries are checked against the current versions in
+one query, so a write made by any worker or job invalidates exactly the
+monkeys whose version it bumped.
+"""
+import collections
+
+from monkeyapp import models, versions
+from monkeyapp.cache import LRUCache, create_backend
+from monkeyapp.models import User, EDGE_CHUNK
+from monkeyapp.versions import data_version
+
+
+class Profile(collections.namedtuple('Profile', [
+        'id', 'name', 'email', 'age', 'best_friend_id',
+        'best_friend_name', 'friend_ids', 'version'])):
+    __slots__ = ()
+
+    @property
+    def friend_count(self):
+        return len(self.friend_ids)
+
+    def has_non_friends(self):
+        return models.has_non_friends(self.id)
+
+
+def load(ids):
+    """Read the profiles of the monkeys in *ids* and their versions into
+    a dict of (version, profile) by id, one statement per chunk."""
+    edge = models.edges('friend')
+    rows = {}
+    for chunk in models.chunks(ids, EDGE_CHUNK):
+        # A row per friend, the monkey's columns repeated on each.
+        query = (
+            models.query_rows()
+            .add_columns(edge.c.m2_id, data_version.c.version)
+            .outerjoin(edge, edge.c.m1_id == User.id)
+            .outerjoin(data_version, data_version.c.key ==
+                       versions.monkey_key_column(User.id))
+            .filter(User.id.in_(chunk)))
+        for row in query:
+            monkey = models.MonkeyRow._make(row[:-2])
+            friend_id, version = row[-2:]
+            _, _, friends = rows.setdefault(
+                monkey.id, (version or 0, monkey, set()))
+            if friend_id is not None:
+                friends.add(friend_id)
+    return dict((ident, (version, Profile(
+        row.id, row.name, row.email, row.age, row.best_friend_id,
+        row.best_friend_name, tuple(sorted(friends)), version)))
+        for ident, (version, row, friends) in rows.items())
+
+
+class ProfileCache(object):
+    """Profiles in a *local* cache and an optional *shared* one, with
+    hit counts per tier."""
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.stats = dict(hits=0, shared_hits=0, misses=0)
+
+    def key(self, ident):
+        return 'profile:%i' % ident
+
+    def cached(self, ids):
+        """Return a dict of (version, profile, tier) by id of the entries
+        cached for *ids*, current or not."""
+        entries = {}
+        for ident in ids:
+            entry = self.local.get(self.key(ident))
+            if entry is not None:
+                entries[ident] = entry + ('hits',)
+        missing = [ident for ident in ids if ident not in entries]
+        if missing and self.shared is not None:
+            for ident, entry in zip(missing, self.shared.get_many(
+                    *[self.key(ident) for ident in missing])):
+                if entry is not None:
+                    entries[ident] = entry + ('shared_hits',)
+        return entries
+
+    def get_many(self, ids):
+        """Return a dict of the profiles of the monkeys in *ids* that
+        exist, loading the missing and outdated ones in one go."""
+        ids = list(set(ids))
+        if not ids:
+            return {}
+        entries = self.cached(ids)
+        current = versions.monkey_versions(entries) if entries else {}
+        found = {}
+        for ident, (version, profile, tier) in entries.items():
+            if version == current[ident]:
+                found[ident] = profile
+                self.stats[tier] += 1
+                if tier == 'shared_hits':
+                    self.local.set(self.key(ident), (version, profile))
+        missing = [ident for ident in ids if ident not in found]
+        if missing:
+            self.stats['misses'] += len(missing)
+            loaded = load(missing)
+            stored = dict((self.key(ident), entry)
+                          for ident, entry in loaded.items())
+            self.local.set_many(stored)
+            if self.shared is not None:
+                self.shared.set_many(stored)
+            found.update((ident, profile)
+                         for ident, (_, profile) in loaded.items())
+        return found
+
+    def get(self, ident):
+        """Return the profile of monkey *ident*, None if there is none."""
+        return self.get_many([ident]).get(ident)
+
+    def get_with_friends(self, ident):
+        """Return the profile of monkey *ident* and a dict of its friends'
+        profiles by id, (None, {}) if there is none.
+
+        When the monkey is cached, its friends are looked up with it, so
+        one query checks every version.
+        """
+        entry = self.cached([ident]).get(ident)
+        ids = [ident] + list(entry[1].friend_ids if entry else ())
+        found = self.get_many(ids)
+        profile = found.get(ident)
+        if profile is None:
+            return None, {}
+        # Its friends were read from an outdated entry.
+        missing = [i for i in profile.friend_ids if i not in found]
+        found.update(self.get_many(missing))
+        return profile, dict((i, found[i]) for i in profile.friend_ids
+                             if i in found)
+
+    def hit_ratio(self):
+        total = sum(self.stats.values())
+        if not total:
+            return None
+        return float(self.stats['hits'] + self.stats['shared_hits']) / total
+
+
+def create_cache(config):
+    shared = None
+    backend = config.get('PROFILE_CACHE_BACKEND')
+    if backend is not None:
+        shared = create_backend(dict(config, CACHE_BACKEND=backend))
+    return ProfileCache(LRUCache(config.get('PROFILE_CACHE_SIZE', 10000),
+                                 config.get('CACHE_TIMEOUT', 300)), shared)
+
+
+def init_app(app):
+    app.profiles = create_cache(app.config)
@@ -0,0 +1,198 @@
+import collections
+
+from sqlalchemy import Table, Column, Integer, Index, select, func
+from sqlalchemy import and_, exists
+
+from monkeyapp.database import Base, db_session
+from monkeyapp.models import User, adjacency, chunks, int_rows, ROWS_CHUNK
+from monkeyapp.models import edges, friend_ids, is_friend
+from monkeyapp.models import on_friendships_changed
+
+# Number of friends every pair of monkeys has in common, in both
+# directions, for pairs with at least one. Friends are counted too,
+# readers filter them out. Derived data, so no foreign keys.
+#
+# Hubs, monkeys with more than HUB_DEGREE friends, are not counted as
+# mutual friends: sharing one says little, and each would add its
+# degree squared rows and as many updates per new friend.
+mutual_friend = Table(
+    'mutual_friend', Base.metadata,
+    Column('m1_id', Integer, primary_key=True),
+    Column('m2_id', Integer, primary_key=True),
+    Column('mutual', Integer, nullable=False))
+# Serves the top-K scan of a monkey's candidates.
+Index('ix_mutual_friend_m1_mutual', mutual_friend.c.m1_id,
+      mutual_friend.c.mutual, mutual_friend.c.m2_id)
+
+# Monkeys whose counts predate mutual_friend and are not built yet.
+mutual_friend_pending = Table(
+    'mutual_friend_pending', Base.metadata,
+    Column('monkey_id', Integer, primary_key=True))
+
+HUB_DEGREE = 200
+LIMIT = 10
+BUILD_BATCH = 200
+# The live fallback looks at the friends of at most LIVE_FRIENDS of a
+# monkey's friends, those with the fewest friends first.
+LIVE_FRIENDS = 50
+
+
+def pair_deltas(pairs, sign):
+    """Return a Counter of mutual friend count changes caused by adding
+    (sign 1) or removing (sign -1) the friendships in *pairs*, which
+    have already been written.
+
+    The monkeys in *pairs* are locked by models.lock_users, so no other
+    transaction changes their friends until this one ends.
+    """
+    neighbours = adjacency(set(ident for pair in pairs for ident in pair))
+    # Walk back to the state before the change, then replay it edge by
+    # edge so that edges within *pairs* count for each other.
+    for a, b in pairs:
+        if sign > 0:
+            neighbours[a].discard(b)
+            neighbours[b].discard(a)
+        else:
+            neighbours[a].add(b)
+            neighbours[b].add(a)
+    deltas = collections.Counter()
+
+    def count_through(friends, step):
+        for x in friends:
+            for y in friends:
+                if x != y:
+                    deltas[(x, y)] += step
+
+    for a, b in pairs:
+        # a becomes or stops being a mutual friend of b and each of its
+        # other friends, unless it is or was a hub.
+        for w, other in ((a, b), (b, a)):
+            before = neighbours[w]
+            if sign > 0:
+                after = before | set([other])
+            else:
+                after = before - set([other])
+            if len(before) <= HUB_DEGREE and len(after) <= HUB_DEGREE:
+                for x in before & after:
+                    deltas[(other, x)] += sign
+                    deltas[(x, other)] += sign
+            elif len(before) <= HUB_DEGREE:
+                count_through(before, -1)
+            elif len(after) <= HUB_DEGREE:
+                count_through(after, 1)
+            neighbours[w] = after
+    return deltas
+
+
+@on_friendships_changed
+def update_mutual_friends(pairs, sign):
+    deltas = sorted((a, b, delta) for (a, b), delta
+                    in pair_deltas(pairs, sign).items() if delta)
+    # Three set-based statements per chunk of pairs, joined against the
+    # deltas as a derived table.
+    table = mutual_friend
+    for chunk in chunks(deltas, ROWS_CHUNK):
+        rows = int_rows(chunk, ('a', 'b', 'delta'), 'deltas')
+        match = and_(rows.c.a == table.c.m1_id, rows.c.b == table.c.m2_id)
+        # Narrows the rows looked at to an index range per monkey.
+        touched = and_(table.c.m1_id.in_(set(a for a, _, _ in chunk)),
+                       exists().where(match))
+        db_session.execute(table.update().where(touched).values(
+            mutual=table.c.mutual + select([rows.c.delta]).where(match)
+            .as_scalar()))
+        db_session.execute(table.insert().from_select(
+            ['m1_id', 'm2_id', 'mutual'],
+            select([rows.c.a, rows.c.b, rows.c.delta])
+            .where(and_(rows.c.delta > 0, ~exists().where(match)))))
+        db_session.execute(table.delete().where(
+            and_(touched, table.c.mutual <= 0)))
+
+
+def is_pending(ident):
+    return db_session.query(exists().where(
+        mutual_friend_pending.c.monkey_id == ident)).scalar()
+
+
+def recommend(ident, limit=LIMIT):
+    """Return (id, name, mutual friend count) of the non-friends of
+    *ident* sharing the most friends with it, and whether the counts
+    are exact."""
+    if is_pending(ident):
+        return live_recommendations(ident, limit), False
+    mutual = mutual_friend.c.mutual
+    rows = (
+        db_session.query(User.id, User.name, mutual)
+        .join(mutual_friend, mutual_friend.c.m2_id == User.id)
+        .filter(mutual_friend.c.m1_id == ident,
+                ~is_friend(ident, User.id))
+        .order_by(mutual.desc(), mutual_friend.c.m2_id.desc())
+        .limit(limit))
+    return rows.all(), True
+
+
+def live_recommendations(ident, limit=LIMIT):
+    """Count mutual friends over a bounded sample of the friends."""
+    near = (
+        select([User.id])
+        .where(and_(User.id.in_(friend_ids(ident)),
+                    User.friend_count <= HUB_DEGREE))
+        .order_by(User.friend_count, User.id)
+        .limit(LIVE_FRIENDS).alias('near'))
+    edge = edges('fof')
+    count = func.count().label('mutual')
+    return (
+        db_session.query(User.id, User.name, count)
+        .select_from(near)
+        .join(edge, edge.c.m1_id == near.c.id)
+        .join(User, User.id == edge.c.m2_id)
+        .filter(User.id != ident, ~is_friend(ident, User.id))
+        .group_by(User.id, User.name)
+        .order_by(count.desc(), User.id.desc())
+        .limit(limit)).all()
+
+
+def build(ids):
+    """Recount the mutual friends of the monkeys in *ids* from scratch."""
+    first, second = edges('first'), edges('second')
+    hub = User.__table__.alias('hub')
+    for chunk in chunks(ids, BUILD_BATCH):
+        db_session.execute(mutual_friend.delete().where(
+            mutual_friend.c.m1_id.in_(chunk)))
+        db_session.execute(mutual_friend.insert().from_select(
+            ['m1_id', 'm2_id', 'mutual'],
+            select([first.c.m1_id, second.c.m2_id, func.count()])
+            .select_from(
+                first.join(second, second.c.m1_id == first.c.m2_id)
+                .join(hub, hub.c.id == first.c.m2_id))
+            .where(and_(first.c.m1_id.in_(chunk),
+                        second.c.m2_id != first.c.m1_id,
+                        hub.c.friend_count <= HUB_DEGREE))
+            .group_by(first.c.m1_id, second.c.m2_id)))
+        db_session.execute(mutual_friend_pending.delete().where(
+            mutual_friend_pending.c.monkey_id.in_(chunk)))
+
+
+def mark_all_pending():
+    """Queue every monkey for build_pending, to recount all mutual friends
+    from the friendship table."""
+    pending = mutual_friend_pending.c.monkey_id
+    db_session.execute(mutual_friend_pending.insert().from_select(
+        ['monkey_id'],
+        select([User.id]).where(~exists().where(pending == User.id))))
+    db_session.commit()
+
+
+def build_pending(batch_size=BUILD_BATCH):
+    """Build the pending monkeys, committing every *batch_size* of them,
+    and return how many were built."""
+    built = 0
+    while True:
+        ids = [ident for ident, in db_session.execute(
+            select([mutual_friend_pending.c.monkey_id])
+            .order_by(mutual_friend_pending.c.monkey_id)
+            .limit(batch_size))]
+        if not ids:
+            return built
+        build(ids)
+        db_session.commit()
+        built += len(ids)
@@ -0,0 +1,78 @@
+"""WSGI middleware sampling requests into an NDJSON file for replay.
+
+Turned on with ``TRAFFIC_RECORD`` (the file to append to) and
+``TRAFFIC_SAMPLE`` (the share of requests kept, 1.0 by default). Each
+line holds the start time, method, path, query string, form or JSON
+body and the status and duration seen. Replay them with
+``python -m benchmarks.replay``.
+"""
+import json
+import random
+import threading
+import time
+from io import BytesIO
+
+from werkzeug.wsgi import ClosingIterator
+
+# Bodies of these types are recorded, others (uploads) are left out.
+TEXT_TYPES = ('application/x-www-form-urlencoded', 'application/json')
+MAX_BODY = 64 * 1024
+
+
+class TrafficRecorder(object):
+    def __init__(self, app, path, sample=1.0):
+        self.app = app
+        self.path = path
+        self.sample = sample
+        self.lock = threading.Lock()
+        self.out = open(path, 'a')
+
+    def read_body(self, environ):
+        content_type = environ.get('CONTENT_TYPE', '').split(';')[0]
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if not length or content_type not in TEXT_TYPES or \
+                length > MAX_BODY:
+            return None
+        body = environ['wsgi.input'].read(length)
+        environ['wsgi.input'] = BytesIO(body)
+        return body.decode('utf-8', 'replace')
+
+    def __call__(self, environ, start_response):
+        if random.random() >= self.sample:
+            return self.app(environ, start_response)
+        record = dict(
+            ts=time.time(),
+            method=environ['REQUEST_METHOD'],
+            path=environ.get('PATH_INFO', ''),
+            query=environ.get('QUERY_STRING', ''),
+            content_type=environ.get('CONTENT_TYPE') or None,
+            body=self.read_body(environ))
+        status = []
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status[:] = [int(status_line.split(' ', 1)[0])]
+            return start_response(status_line, headers, exc_info)
+
+        def done():
+            # Runs once the response has been sent.
+            record.update(status=status[0] if status else None,
+                          ms=round((time.time() - record['ts']) * 1000, 3))
+            self.write(record)
+        return ClosingIterator(
+            self.app(environ, recording_start_response), [done])
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            self.out.write(line)
+            self.out.flush()
+
+
+def init_app(app):
+    path = app.config.get('TRAFFIC_RECORD')
+    if path:
+        app.wsgi_app = TrafficRecorder(
+            app.wsgi_app, path, app.config.get('TRAFFIC_SAMPLE', 1.0))
@@ -0,0 +1,39 @@
+"""Send the reads of safe requests to a replica database.
+
+A request that may write pins its client to the primary for
+REPLICA_STICKY_SECONDS, so it reads its own writes while the replicas
+catch up.
+"""
+import random
+import time
+
+from flask import request, session
+
+from monkeyapp.database import db_session, make_engine
+
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+def init_app(app):
+    app.replicas = [make_engine(uri, app.config)
+                    for uri in app.config.get('DATABASE_REPLICAS', ())]
+
+    @app.before_request
+    def route_session():
+        if not app.replicas:
+            return
+        now = time.time()
+        if request.method not in SAFE_METHODS:
+            session['primary_until'] = now + app.config.get(
+                'REPLICA_STICKY_SECONDS', 10)
+        elif session.get('primary_until', 0) <= now:
+            db_session().info['replica'] = random.choice(app.replicas)
+
+    @app.teardown_request
+    def shutdown_session(exception=None):
+        # Safe requests skip the commit unless they did write.
+        current = db_session()
+        if (request.method not in SAFE_METHODS or current.info.get('wrote')
+                or current.new or current.dirty or current.deleted):
+            db_session.commit()
+        db_session.remove()
@@ -0,0 +1,346 @@
+"""Substring and fuzzy search over monkey names and emails.
+
+PostgreSQL answers from pg_trgm indexes, and queries too short for a
+trigram from pattern indexes matching the start. Other databases use an n-gram
+index kept in each worker, updated on every commit that creates, edits
+or deletes a monkey.
+"""
+import collections
+import threading
+import time
+from array import array
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, or_, select, case
+from sqlalchemy.orm import Session, object_session
+
+from monkeyapp.database import db_session
+from monkeyapp.models import User
+
+LIMIT = 10
+# Fuzzy matches share at least this part of their trigrams with the
+# query, like pg_trgm's default similarity threshold.
+SIMILARITY = 0.3
+# A substring search checks the ids in all of the query's posting lists
+# if there are at most MAX_CANDIDATES, and is left to the database
+# otherwise. Fuzzy matches are looked for among as many ids from the
+# posting lists, rarest first.
+MAX_CANDIDATES = 5000
+INDEX_MAX_CHANGES = 100000
+
+TRIGRAM_INDEXES = (
+    ('ix_user_name_trgm', 'name'),
+    ('ix_user_email_trgm', 'email'),
+)
+# Prefix LIKE on lower(column) under any collation, for short queries.
+PATTERN_INDEXES = (
+    ('ix_user_name_lower_pattern', 'name'),
+    ('ix_user_email_lower_pattern', 'email'),
+)
+
+
+def create_trigram_indexes(connection):
+    connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    existing = set(name for name, in connection.execute(
+        "SELECT indexname FROM pg_indexes WHERE tablename = 'user'"))
+    for name, column in TRIGRAM_INDEXES:
+        if name not in existing:
+            connection.execute(
+                'CREATE INDEX %s ON "user" USING gin (lower(%s) '
+                'gin_trgm_ops)' % (name, column))
+
+
+def create_pattern_indexes(connection):
+    for name, column in PATTERN_INDEXES:
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS %s ON "user" (lower(%s) '
+            'text_pattern_ops)' % (name, column))
+
+
+@event.listens_for(User.__table__, 'after_create')
+def user_created(table, connection, **kw):
+    if connection.dialect.name == 'postgresql':
+        create_trigram_indexes(connection)
+        create_pattern_indexes(connection)
+
+
+def grams(text):
+    """Return the trigrams of *text*, padded like pg_trgm's."""
+    padded = u'  %s ' % text.lower()
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def query_grams(query):
+    # Every trigram of a substring is in the text. Queries too short to
+    # have one match the start of a name or email.
+    if len(query) < 3:
+        return set([(u'  ' + query)[-3:]])
+    return set(query[i:i + 3] for i in range(len(query) - 2))
+
+
+def substring_rank(query, name, email):
+    for rank, matches in enumerate((
+            name == query, name.startswith(query), query in name,
+            email.startswith(query), query in email)):
+        if matches:
+            return rank, len(name)
+    return None
+
+
+class NgramIndex(object):
+    """Trigram posting lists of the lower case names and emails.
+
+    Edits and deletes leave the old postings behind; results are checked
+    against the current texts, and the index is rebuilt once it has
+    INDEX_MAX_CHANGES changes or is old.
+    """
+
+    def __init__(self):
+        self.texts = {}
+        self.postings = collections.defaultdict(lambda: array('i'))
+        self.changes = 0
+        self.built = time.time()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        index = cls()
+        rows = db_session.execute(
+            select([User.id, User.name, User.email])
+            .execution_options(stream_results=True))
+        for ident, name, email in rows:
+            index.add(ident, name, email)
+        return index
+
+    def add(self, ident, name, email):
+        text = (name.lower(), email.lower())
+        old = self.texts.get(ident)
+        known = grams(old[0]) | grams(old[1]) if old else set()
+        self.texts[ident] = text
+        for gram in grams(text[0]) | grams(text[1]):
+            if gram not in known:
+                self.postings[gram].append(ident)
+
+    def apply(self, changes):
+        with self.lock:
+            for ident, name, email in changes:
+                if name is None:
+                    self.texts.pop(ident, None)
+                else:
+                    self.add(ident, name, email)
+            self.changes += len(changes)
+
+    def stale(self, max_age):
+        return (self.changes > INDEX_MAX_CHANGES or
+                time.time() - self.built > max_age)
+
+    def search(self, query, limit):
+        """Return the ids of the best matches of lower case *query*, None
+        if it has too many candidates to rank here."""
+        with self.lock:
+            found = self.substring_matches(query)
+            if found is None:
+                return None
+            ids = [ident for _, ident in sorted(found)[:limit]]
+            if len(ids) < limit and len(query) >= 3:
+                ids += self.fuzzy_matches(query, limit - len(ids), set(ids))
+            return ids
+
+    def substring_matches(self, query):
+        lists = sorted((self.postings.get(gram, ())
+                        for gram in query_grams(query)), key=len)
+        candidates = set(lists[0])
+        for posting in lists[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(posting)
+        if len(candidates) > MAX_CANDIDATES:
+            return None
+        found = []
+        for ident in candidates:
+            text = self.texts.get(ident)
+            if (text is None or
+                    (query not in text[0] and query not in text[1])):
+                continue
+            found.append((substring_rank(query, *text) + (text[0], ident),
+                          ident))
+        return found
+
+    def fuzzy_matches(self, query, limit, exclude):
+        wanted = grams(query)
+        shared = collections.Counter()
+        budget = MAX_CANDIDATES
+        for posting in sorted((self.postings.get(gram, ())
+                               for gram in wanted), key=len):
+            part = posting[:budget]
+            shared.update(set(part))
+            budget -= len(part)
+            if not budget:
+                break
+        scored = []
+        for ident, _ in shared.most_common(limit * 5):
+            text = self.texts.get(ident)
+            if text is None or ident in exclude:
+                continue
+            score = max(similarity(wanted, grams(field)) for field in text)
+            if score >= SIMILARITY:
+                scored.append((-score, text[0], ident))
+        return [ident for _, _, ident in sorted(scored)[:limit]]
+
+
+def similarity(a, b):
+    return float(len(a & b)) / len(a | b)
+
+
+def init_index(app):
+    if not hasattr(app, 'search_index_lock'):
+        app.search_index = None
+        # Changes committed while an index is loading, None otherwise.
+        app.search_index_backlog = None
+        app.search_index_lock = threading.Lock()
+
+
+def load_index(app):
+    """Build the search index of *app* and swap it in."""
+    init_index(app)
+    try:
+        with app.app_context():
+            try:
+                index = NgramIndex.load()
+            finally:
+                db_session.remove()
+    except Exception:
+        with app.search_index_lock:
+            app.search_index_backlog = None
+        raise
+    with app.search_index_lock:
+        for changes in app.search_index_backlog or ():
+            index.apply(changes)
+        app.search_index = index
+        app.search_index_backlog = None
+    return index
+
+
+def get_index(app):
+    """Return the search index of *app*, None while it is first loaded.
+
+    A missing or stale index is loaded in a background thread.
+    """
+    if not app.config.get('SEARCH_INDEX', True):
+        return None
+    init_index(app)
+    index = app.search_index
+    max_age = app.config.get('SEARCH_INDEX_MAX_AGE', 600)
+    if index is None or index.stale(max_age):
+        with app.search_index_lock:
+            if app.search_index_backlog is None:
+                app.search_index_backlog = []
+                thread = threading.Thread(target=load_index, args=(app,))
+                thread.daemon = True
+                thread.start()
+    return index
+
+
+def remember(session, change):
+    if session is not None:
+        session.info.setdefault('search', []).append(change)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def monkey_saved(mapper, connection, target):
+    remember(object_session(target), (target.id, target.name, target.email))
+
+
+@event.listens_for(User, 'after_delete')
+def monkey_deleted(mapper, connection, target):
+    remember(object_session(target), (target.id, None, None))
+
+
+def reload_index():
+    """Have the index rebuilt after the current transaction commits,
+    for writes that bypass the ORM."""
+    db_session().info['search_reload'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def update_index(session):
+    changes = session.info.pop('search', None)
+    reload = session.info.pop('search_reload', False)
+    if not (changes or reload) or not has_app_context():
+        return
+    app = current_app._get_current_object()
+    if not hasattr(app, 'search_index_lock'):
+        return
+    with app.search_index_lock:
+        if app.search_index is not None:
+            app.search_index.apply(changes or [])
+            if reload:
+                app.search_index.built = 0
+        if app.search_index_backlog is not None:
+            app.search_index_backlog.append(changes or [])
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget(session):
+    session.info.pop('search', None)
+    session.info.pop('search_reload', None)
+
+
+def like_pattern(query, prefix=False):
+    for char in '\\%_':
+        query = query.replace(char, '\\' + char)
+    return (u'' if prefix else u'%') + query + u'%'
+
+
+def sql_search(query, limit, trigram=False):
+    name, email = func.lower(User.name), func.lower(User.email)
+    starts, contains = like_pattern(query, prefix=True), like_pattern(query)
+    # Like the index, queries too short for a trigram match the start.
+    short = len(query) < 3
+    pattern = starts if short else contains
+    condition = or_(name.like(pattern, escape='\\'),
+                    email.like(pattern, escape='\\'))
+    rows = db_session.query(User.id, User.name, User.email)
+    # Substring matches first, ordered like substring_rank.
+    rank = case([(name == query, 0),
+                 (name.like(starts, escape='\\'), 1),
+                 (name.like(contains, escape='\\'), 2),
+                 (email.like(starts, escape='\\'), 3),
+                 (email.like(contains, escape='\\'), 4)], else_=5)
+    if not trigram:
+        return (rows.filter(condition)
+                .order_by(rank, func.length(User.name), name, User.id)
+                .limit(limit).all())
+    if not short:
+        # psycopg2 needs the % of pg_trgm's similarity operator doubled.
+        condition = or_(condition, name.op('%%')(query),
+                        email.op('%%')(query))
+    similarity = func.greatest(func.similarity(name, query),
+                               func.similarity(email, query))
+    return (rows.filter(condition)
+            .order_by(rank, similarity.desc(), User.name)
+            .limit(limit).all())
+
+
+def search(query, limit=LIMIT):
+    """Return (id, name, email) rows of the monkeys best matching
+    *query*, substring matches first."""
+    query = query.strip().lower()
+    if not query:
+        return []
+    app = current_app._get_current_object()
+    if app.engine.dialect.name == 'postgresql':
+        return sql_search(query, limit, trigram=True)
+    index = get_index(app)
+    if index is None:
+        return sql_search(query, limit)
+    ids = index.search(query, limit)
+    if ids is None:
+        return sql_search(query, limit)
+    if not ids:
+        return []
+    # The index only sees this worker's writes.
+    rows = dict((row.id, row) for row in db_session.query(
+        User.id, User.name, User.email).filter(User.id.in_(ids)))
+    return [rows[ident] for ident in ids if ident in rows]
@@ -0,0 +1,75 @@
+"""Pages sent while they render, gzipped on the fly when accepted.
+
+With ``STREAM_TEMPLATES`` on, render_page streams the template, so the
+head of the page leaves before the slow parts are read. The pages'
+bodies are the same cached fragments as when not streaming, rendered
+where the template outputs them; nothing is read from a cursor as it is
+sent.
+"""
+import zlib
+
+from flask import current_app, render_template, request, Response
+from flask import stream_with_context
+
+# Every piece of the first HEAD_BYTES is sent at once, so the head of
+# the page leaves before the body is read; after that pieces are sent
+# in batches of FLUSH_BYTES.
+HEAD_BYTES = 8 * 1024
+FLUSH_BYTES = 16 * 1024
+
+
+class Deferred(object):
+    """Markup rendered only when a template outputs it."""
+
+    def __init__(self, render):
+        self.render = render
+
+    def __html__(self):
+        return self.render()
+
+
+def stream_template(template_name, **context):
+    """Like render_template, yielding the page in pieces."""
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+    return template.generate(context)
+
+
+def batches(chunks):
+    """Encode *chunks* and join them into the pieces to send."""
+    sent, pending = 0, []
+    for chunk in chunks:
+        pending.append(chunk.encode('utf-8'))
+        if sent < HEAD_BYTES or sum(map(len, pending)) >= FLUSH_BYTES:
+            data = b''.join(pending)
+            sent += len(data)
+            pending = []
+            yield data
+    if pending:
+        yield b''.join(pending)
+
+
+def gzip_stream(pieces, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for piece in pieces:
+        # A sync flush makes everything so far decodable by the client.
+        yield compressor.compress(piece) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def streaming():
+    return current_app.config.get('STREAM_TEMPLATES', False)
+
+
+def render_page(template_name, **context):
+    """Render a page, streamed if STREAM_TEMPLATES is set."""
+    if not streaming():
+        return render_template(template_name, **context)
+    pieces = batches(stream_template(template_name, **context))
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        headers['Content-Encoding'] = 'gzip'
+        pieces = gzip_stream(pieces)
+    return Response(stream_with_context(pieces), headers=headers,
+                    mimetype='text/html')
@@ -0,0 +1,110 @@
+import datetime
+
+from sqlalchemy import Table, Column, String, Integer, DateTime, select
+from sqlalchemy import event, literal, cast
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from monkeyapp.database import Base, db_session
+
+# A counter for the whole data set and one per monkey, bumped in the
+# same transaction as every write so readers can tell when what they
+# hold is still current.
+data_version = Table(
+    'data_version', Base.metadata,
+    Column('key', String(40), primary_key=True),
+    Column('version', Integer, nullable=False),
+    Column('modified', DateTime, nullable=False))
+
+GLOBAL = 'global'
+CHUNK = 400
+
+# Called with the ids bumped in a transaction once it has committed.
+listeners = []
+
+
+def on_commit(listener):
+    listeners.append(listener)
+    return listener
+
+
+def monkey_key(ident):
+    return 'monkey:%i' % ident
+
+
+def monkey_key_column(column):
+    """Like monkey_key, in SQL for the ids in *column*."""
+    return literal('monkey:', String) + cast(column, String)
+
+
+def bump(ids=()):
+    """Bump the global version and that of every monkey in *ids*."""
+    ids = set(ids)
+    db_session().info.setdefault('bumped', set()).update(ids)
+    keys = [GLOBAL] + sorted(monkey_key(ident) for ident in ids)
+    # Second precision, since that is all Last-Modified can carry.
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    for i in range(0, len(keys), CHUNK):
+        bump_keys(keys[i:i + CHUNK], now)
+
+
+def bump_keys(keys, now):
+    column = data_version.c
+    while True:
+        existing = set(key for key, in db_session.execute(
+            select([column.key]).where(column.key.in_(keys))))
+        missing = [key for key in keys if key not in existing]
+        if not missing:
+            break
+        try:
+            with db_session.begin_nested():
+                db_session.execute(data_version.insert().values([
+                    dict(key=key, version=1, modified=now)
+                    for key in missing]))
+            break
+        except IntegrityError:
+            # Another transaction inserted some of them first; look
+            # again and bump those instead.
+            pass
+    if existing:
+        db_session.execute(
+            data_version.update().where(column.key.in_(existing))
+            .values(version=column.version + 1, modified=now))
+
+
+def get(key):
+    """Return (version, modified) of *key*, (0, None) if never written."""
+    row = db_session.execute(
+        select([data_version.c.version, data_version.c.modified])
+        .where(data_version.c.key == key)).first()
+    if row is None:
+        return 0, None
+    return row.version, row.modified
+
+
+def monkey_versions(ids):
+    """Return a dict of the version of every monkey in *ids*, 0 for the
+    ones never written."""
+    keys = dict((monkey_key(ident), ident) for ident in ids)
+    found = dict.fromkeys(keys.values(), 0)
+    column = data_version.c
+    names = sorted(keys)
+    for i in range(0, len(names), CHUNK):
+        for key, version in db_session.execute(
+                select([column.key, column.version])
+                .where(column.key.in_(names[i:i + CHUNK]))):
+            found[keys[key]] = version
+    return found
+
+
+@event.listens_for(Session, 'after_commit')
+def notify(session):
+    ids = session.info.pop('bumped', None)
+    if ids is not None:
+        for listener in listeners:
+            listener(ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget(session):
+    session.info.pop('bumped', None)
@@ -1,6 +1,11 @@
-from flask import request, render_template, flash
+import operator
+
+from flask import request, render_template, flash, abort, current_app
+from flask import jsonify, Response, stream_with_context
 from flask import redirect, url_for, Blueprint
-from monkeyapp import models, forms
+from monkeyapp import models, forms, importer, export, versions
+from monkeyapp import recommendations, analytics, search, changes
+from monkeyapp import streaming, jobs
 from monkeyapp.database import db_session
 
 api = Blueprint('api', __name__)
@@ -17,44 +22,124 @@ def monkeys():
     if request.method == 'POST' and form.validate():
         user = models.User(form.name.data, form.email.data, form.age.data)
         db_session.add(user)
+        db_session.flush()
+        versions.bump([user.id])
         db_session.commit()
         flash("New monkey added")
         return redirect(url_for(".monkeys"))
-    monkeys = models.query_users(order=request.args.get('ord'))
+    order, cursor = request.args.get('ord'), request.args.get('cursor')
+    per_page = current_app.config['MONKEYS_PER_PAGE']
+
+    def render_table():
+        try:
+            page = models.paginate_rows(
+                order=order, cursor=cursor, per_page=per_page)
+        except ValueError:
+            abort(400)
+        return render_template(
+            '_monkey_table.html', monkeys=page.items, page=page,
+            order=order)
+    def table():
+        return current_app.cache.fragment(
+            'list', current_app.cache.list_key(order, cursor, str(per_page)),
+            render_table)
+    if streaming.streaming():
+        # Checked now, the status is sent before the table renders.
+        try:
+            models.check_page(order, cursor)
+        except ValueError:
+            abort(400)
+        return streaming.render_page(
+            'monkeys.html', table=streaming.Deferred(table), form=form,
+            order=order)
     return render_template(
-        'monkeys.html', monkeys=monkeys.all(), form=form,
-        order=request.args.get('ord'))
+        'monkeys.html', table=table(), form=form, order=order)
 
 
 @api.route("/monkey/<int:ident>", methods=["post", "get"])
 def view_monkey(ident):
-    try:
-        monkey = models.User.query.filter_by(id=ident).one()
-    except:
+    profile, friends = current_app.profiles.get_with_friends(ident)
+    if profile is None:
         return redirect(404)
     form = forms.FriendForm(request.form)
-    form.user.query_factory = monkey.get_non_friends
-    best_friend_form = forms.BestFriendForm(user=monkey.best_friend)
-    best_friend_form.user.query_factory = monkey.friends.all
     if request.method == 'POST':
+        friend = None
         if form.validate():
-            monkey.add_friend(form.user.data)
+            monkey = models.User.query.get(ident)
+            friend = monkey.get_non_friends().filter(
+                models.User.id == form.user.data).first()
+        if friend is not None:
+            monkey.add_friend(friend)
+            db_session.commit()
             flash("Friend added")
-            form = forms.FriendForm(request.form)
-            form.user.query_factory = monkey.get_non_friends
+            form = forms.FriendForm()
+            profile, friends = current_app.profiles.get_with_friends(ident)
         else:
             flash("Form not valid")
+    friends = sorted(friends.values(), key=operator.attrgetter('name'))
+    best_friend_form = forms.BestFriendForm(user=next(
+        (f for f in friends if f.id == profile.best_friend_id), None))
+    best_friend_form.user.query_factory = lambda: friends
+    best_friend_form.user.get_pk = operator.attrgetter('id')
+    suggestions, _ = recommendations.recommend(ident, 5)
+
+    def friend_list():
+        return current_app.cache.fragment(
+            'friends', current_app.cache.friends_key(ident, profile.version),
+            lambda: render_template('_friend_list.html', monkey=profile,
+                                    friends=friends))
+    if streaming.streaming():
+        return streaming.render_page(
+            'monkey.html', monkey=profile, form=form,
+            best_friend_form=best_friend_form,
+            friend_list=streaming.Deferred(friend_list),
+            suggestions=suggestions)
     return render_template(
-        'monkey.html', monkey=monkey, form=form,
-        best_friend_form=best_friend_form)
+        'monkey.html', monkey=profile, form=form,
+        best_friend_form=best_friend_form, friend_list=friend_list(),
+        suggestions=suggestions)
 
 
-@api.route("/monkey/<int:ident>/add_best_friend/", methods=["post", "get"])
-def add_best_friend(ident, methods=["post"]):
+@api.route("/monkey/<int:ident>/non_friends")
+def search_non_friends(ident):
+    try:
+        monkey = models.User.query.filter_by(id=ident).one()
+    except:
+        return redirect(404)
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    results = monkey.search_non_friends(request.args.get('q', u''), limit)
+    return jsonify(results=[
+        dict(id=friend_id, name=name) for friend_id, name in results])
+
+
+@api.route("/monkey/<int:ident>/add_friends", methods=["post"])
+def add_friends(ident):
     try:
         monkey = models.User.query.filter_by(id=ident).one()
     except:
         return redirect(404)
+    added = monkey.add_friends(request.form.getlist('ids', type=int))
+    db_session.commit()
+    return jsonify(added=added)
+
+
+@api.route("/monkey/<int:ident>/remove_friends", methods=["post"])
+def remove_friends(ident):
+    if current_app.profiles.get(ident) is None:
+        return redirect(404)
+    job, removed = jobs.submit(
+        'unfriend', ident=ident, ids=request.form.getlist('ids', type=int))
+    db_session.commit()
+    if job is not None:
+        return jobs.accepted(job)
+    return jsonify(removed=removed)
+
+
+@api.route("/monkey/<int:ident>/add_best_friend/", methods=["post", "get"])
+def add_best_friend(ident, methods=["post"]):
+    monkey = models.User.query.get(ident)
+    if monkey is None:
+        return redirect(404)
     form = forms.BestFriendForm(request.form)
     form.user.query_factory = monkey.friends.all
     if form.validate():
@@ -69,15 +154,14 @@ def add_best_friend(ident, methods=["post"]):
 
 @api.route("/remove_friend/<int:ident1>/<int:ident2>", methods=["post", "get"])
 def remove_friend(ident1, ident2):
-    try:
-        monkey = models.User.query.filter_by(id=ident1).one()
-        friend = models.User.query.filter_by(id=ident2).one()
-    except:
+    profiles = current_app.profiles.get_many([ident1, ident2])
+    if ident1 not in profiles or ident2 not in profiles:
         return redirect(404)
+    monkey, friend = profiles[ident1], profiles[ident2]
     form = forms.RemoveForm(request.form)
     if request.method == 'POST' and form.validate():
         try:
-            monkey.remove_friend(friend)
+            models.User.query.get(ident1).remove_friend(friend)
             flash("Friendship removed")
         except:
             flash("Couldnt remove friendship")
@@ -88,40 +172,78 @@ def remove_friend(ident1, ident2):
 
 @api.route("/edit/<int:ident>", methods=["post", "get"])
 def edit_monkey(ident):
-    try:
-        monkey = models.User.query.filter_by(id=ident).one()
-    except:
+    profile = current_app.profiles.get(ident)
+    if profile is None:
         return redirect(404)
+    if request.method != 'POST':
+        form = forms.MonkeyForm(obj=profile)
+        return render_template('edit_monkey.html', monkey=profile, form=form)
+    monkey = models.User.query.get(ident)
     form = forms.MonkeyForm(request.form, obj=monkey)
-    if request.method == 'POST' and form.validate():
+    if form.validate():
         form.populate_obj(monkey)
+        monkey.touch()
         db_session.commit()
         flash("Monkey updated")
         return redirect(url_for(".view_monkey", ident=ident))
-    return render_template('edit_monkey.html', monkey=monkey, form=form)
+    return render_template('edit_monkey.html', monkey=profile, form=form)
 
 
 @api.route("/remove/<int:ident>", methods=["get", "post"])
 def remove_monkey(ident):
-    try:
-        monkey = models.User.query.filter_by(id=ident).one()
-    except:
+    monkey = current_app.profiles.get(ident)
+    if monkey is None:
         return redirect(404)
     form = forms.RemoveForm(request.form)
     if request.method == 'POST' and form.validate():
-        db_session.delete(monkey)
+        job, _ = jobs.submit('delete_monkey', ident=ident)
         db_session.commit()
-        flash("Monkey removed")
+        if job is None:
+            flash("Monkey removed")
+        else:
+            flash("Monkey will be removed shortly")
         return redirect(url_for(".monkeys"))
     return render_template('remove_monkey.html', monkey=monkey, form=form)
 
 
+@api.route("/import", methods=["post"])
+def import_data():
+    upload = request.files.get('file')
+    if upload is None:
+        abort(400)
+    format = request.form.get(
+        'format', importer.guess_format(upload.filename))
+    if format not in importer.READERS:
+        abort(400)
+    result = importer.import_records(upload.stream, format)
+    return jsonify(result.as_dict())
+
+
+@api.route("/export/<table>.<format>")
+def export_data(table, format):
+    if table not in export.TABLES or format not in export.WRITERS:
+        abort(404)
+    # Consumers of /api/changes resume from here after loading the export.
+    seq = changes.last_seq()
+    return Response(
+        stream_with_context(export.export(table, format)),
+        mimetype=export.MIMETYPES[format],
+        headers={'X-Change-Seq': str(seq)})
+
+
+@api.route("/search")
+def search_monkeys():
+    query = request.args.get('q', u'')
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    return render_template('search.html', query=query,
+                           results=search.search(query, limit))
+
+
+@api.route("/stats")
+def stats():
+    return render_template('stats.html', stats=analytics.latest())
+
+
 @api.app_errorhandler(404)
 def handle_404(error):
     return render_template('page_not_found.html'), 404
-
-
-@api.teardown_request
-def shutdown_session(exception=None):
-    db_session.commit()
-    db_session.remove()
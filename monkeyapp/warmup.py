@@ -0,0 +1,103 @@
+"""Work done when the app starts instead of on its first requests.
+
+With ``WARMUP`` set, create_app compiles every template, configures the
+mappers, builds the forms and opens ``WARMUP_CONNECTIONS`` connections
+to each database. With ``TEMPLATE_CACHE_DIR`` set, compiled templates
+are kept there as bytecode, so later starts load them without
+compiling; ``manage.py compile-templates`` fills it at deploy time. The
+bytecode is loaded as code, so the directory must belong to the user
+running the app and be writable by no one else.
+
+Under gunicorn with ``preload_app`` (see gunicorn.conf.py) the master
+warms up once and the workers fork from it. before_fork closes the
+master's connections, which the workers must not share, and after_fork
+opens each worker's own.
+"""
+import os
+import stat
+import time
+
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import configure_mappers
+
+
+def default_cache_dir():
+    return os.environ.get('TEMPLATE_CACHE_DIR')
+
+
+def bytecode_cache(directory):
+    if not directory:
+        return None
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        # Workers starting together race to create it.
+        if not os.path.isdir(directory):
+            raise
+    info = os.lstat(directory)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+            info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise ValueError("Template cache %s must be a directory of this "
+                         "user that no one else can write to" % directory)
+    return FileSystemBytecodeCache(directory)
+
+
+def compile_templates(app):
+    """Load every template, and return how many there are."""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def build_forms(app):
+    from monkeyapp import forms
+    for form in (forms.MonkeyForm, forms.FriendForm, forms.BestFriendForm,
+                 forms.RemoveForm):
+        form()
+
+
+def engines(app):
+    return [app.engine] + getattr(app, 'replicas', [])
+
+
+def fill_pools(app):
+    count = app.config.get('WARMUP_CONNECTIONS', 2)
+    for engine in engines(app):
+        connections = []
+        try:
+            for _ in range(count):
+                connections.append(engine.connect())
+        except DBAPIError:
+            # Not up yet, connections are opened on demand instead.
+            pass
+        finally:
+            for connection in connections:
+                connection.close()
+
+
+PHASES = (
+    ('templates', compile_templates),
+    ('mappers', lambda app: configure_mappers()),
+    ('forms', build_forms),
+    ('connections', fill_pools),
+)
+
+
+def warm_up(app):
+    """Run the warm-up phases, timing each in app.warmup_seconds."""
+    for name, phase in PHASES:
+        start = time.time()
+        phase(app)
+        app.warmup_seconds[name] = time.time() - start
+
+
+def before_fork(app):
+    for engine in engines(app):
+        engine.dispose()
+
+
+def after_fork(app):
+    if app.config.get('WARMUP'):
+        fill_pools(app)
@@ -1,5 +1,11 @@
 import os
 import monkeyapp
-app = monkeyapp.create_app(os.environ.get("HEROKU_POSTGRESQL_YELLOW_URL"))
+from monkeyapp import warmup
+from monkeyapp.cache import environ_config
+app = monkeyapp.create_app(
+    os.environ.get("HEROKU_POSTGRESQL_YELLOW_URL"),
+    DATABASE_REPLICAS=os.environ.get("DATABASE_REPLICA_URLS", "").split(),
+    WARMUP=True, TEMPLATE_CACHE_DIR=warmup.default_cache_dir(),
+    **environ_config())
 app.config['TESTING'] = True
 app.debug = True